@@ -0,0 +1,424 @@
+"""
+Benchmarks for the Sudoku module.
+Solves, generates and validates puzzles from bundled and generated corpora,
+bucketed by difficulty and size, and reports puzzles per second, latency
+percentiles, peak memory and the number of puzzles left unsolved for each
+case.  Results can be written as JSON and compared against the results of an
+earlier run to catch performance regressions between versions.
+
+Written for Python 3
+"""
+
+# import required libraries
+import argparse
+import json
+import multiprocessing
+import numpy
+import os
+import platform
+import sys
+import time
+import timeit
+
+try:
+    import resource
+except ImportError:
+    # peak memory is not reported where the resource module is missing
+    resource = None
+
+import sudoku
+
+
+################################################################################
+# Lookup tables
+################################################################################
+
+# the sample puzzle that ships with the module
+_BUNDLED_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "insight_sudoku_puzzle.csv")
+
+# well known puzzles that defeat simple propagation
+_HARD_PUZZLES = (
+    # Arto Inkala, 2012
+    "800000000003600000070090200050007000000045700000100030001000068008500010"
+    "090000400",
+    # AI Escargot, Arto Inkala, 2006
+    "100007090030020008009600500005300900010080002600004000300000010040000007"
+    "007000300",
+    # Golden Nugget
+    "000000039000001005003050800008090006070002000100400000009080050020000600"
+    "400700000",
+    # Easter Monster
+    "100000002090400050006000700050903000000070000000850040700000600030009080"
+    "002000001",
+)
+
+# puzzles with 17 numbers, the fewest a puzzle with a unique solution can
+# have, from Gordon Royle's collection
+_SEVENTEEN_CLUE_PUZZLES = (
+    "000000010400000000020000000000050407008000300001090000300400200050100000"
+    "000806000",
+    "000000010400000000020000000000050604008000300001090000300400200050100000"
+    "000807000",
+    "000000012000035000000600070700000300000400800100000000000120000080000040"
+    "050000600",
+    "000000012003600000000007000410020000000500300700000600280000040000300500"
+    "000000000",
+    "000000012008030000000000040120500000000004700060000000507000300000620000"
+    "000100000",
+)
+
+# Easter Monster with one more number that is not in its solution, so
+# neither has a solution but a search takes a few hundred guesses to find out
+_UNSOLVABLE_PUZZLES = (
+    "100090002090400050006000700050903000000070000000850040700000600030009080"
+    "002000001",
+    "100000402090400050006000700050903000000070000000850040700000600030009080"
+    "002000001",
+)
+
+# the difficulty buckets of generated puzzles, see SolveTrace.difficulty()
+_DIFFICULTIES = ("easy", "medium", "hard", "expert")
+
+# the number of puzzles generated for each difficulty bucket is at most this
+# many times the number wanted
+_GENERATION_ATTEMPTS = 20
+
+# the number of puzzles in the generated corpus for each larger grid, by box
+# size, for count=1
+_SIZE_SCALE = {2: 10, 4: 0.2, 5: 0.04}
+
+
+################################################################################
+# Function definitions
+################################################################################
+
+def build_corpora(count=50, seed=0, box_sizes=(2, 4, 5)):
+    """
+    Return a dictionary of named lists of puzzles in the one line format:
+    the bundled sample puzzle, the hard, 17 number and unsolvable sets, up
+    to count generated puzzles for each difficulty, and generated puzzles
+    for each of box_sizes.  Passing the same seed builds the same corpora.
+    """
+    corpora = {}
+    corpora["bundled"] = list(
+        sudoku._grid_line(record.cells)
+        for record in sudoku.read_puzzles(_BUNDLED_FILE)
+        if record.cells is not None)
+    corpora["known-hard"] = list(_HARD_PUZZLES)
+    corpora["17-clue"] = list(_SEVENTEEN_CLUE_PUZZLES)
+    corpora["unsolvable"] = list(_UNSOLVABLE_PUZZLES)
+    for difficulty, puzzles in _bucket_puzzles(count, seed).items():
+        corpora[difficulty] = puzzles
+    for box_size in box_sizes:
+        size = box_size*box_size
+        number = max(1, int(count*_SIZE_SCALE.get(box_size, 1)))
+        corpora["%dx%d" % (size, size)] = list(
+            sudoku._grid_line(puzzle)
+            for puzzle, _ in sudoku.generate(number, seed, box_size=box_size))
+    return corpora
+
+
+def _bucket_puzzles(count, seed):
+    """
+    Generate puzzles until there are count puzzles of each difficulty or
+    too many attempts have been made, and return a dictionary of lists of
+    puzzles in the one line format by difficulty.  Minimal puzzles are mixed
+    in because they are the only source of "expert" puzzles.
+    """
+    buckets = dict((difficulty, []) for difficulty in _DIFFICULTIES)
+    attempts = 0
+    limit = _GENERATION_ATTEMPTS*count
+    while (attempts < limit and
+           any(len(bucket) < count for bucket in buckets.values())):
+        minimal = attempts % 2 == 1
+        for puzzle, _ in sudoku.generate(1, seed + attempts, minimal):
+            result, = sudoku.solve_many([puzzle], workers=1)
+            bucket = buckets[result.trace.difficulty()]
+            if len(bucket) < count:
+                bucket.append(sudoku._grid_line(puzzle))
+        attempts += 1
+    return buckets
+
+
+def bench_solve(puzzles, engine="dlx"):
+    """
+    Solve puzzles one at a time with an engine and return the throughput,
+    the latency of each puzzle and the number left unsolved.
+    """
+    latencies = []
+    statuses = {}
+    timer = timeit.default_timer
+    start = last = timer()
+    for result in sudoku.solve_many(puzzles, workers=1, engine=engine):
+        now = timer()
+        latencies.append(now - last)
+        last = now
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+    stats = _summarize(len(puzzles), last - start, latencies)
+    stats["statuses"] = statuses
+    stats["unsolved"] = len(puzzles) - statuses.get("solved", 0)
+    return stats
+
+
+def bench_solve_array(puzzles, engine="dlx"):
+    """
+    Solve puzzles as one batch with solve_array() and return the throughput
+    and the number left unsolved.
+    """
+    grids = numpy.array(list(sudoku._line_cells(puzzle)
+                             for puzzle in puzzles), numpy.uint8)
+    timer = timeit.default_timer
+    start = timer()
+    solutions, unfinished, unsolvable = sudoku.solve_array(grids, engine)
+    stats = _summarize(len(puzzles), timer() - start)
+    stats["unsolved"] = int((unfinished | unsolvable).sum())
+    return stats
+
+
+def bench_generate(count, seed=0, minimal=False, box_size=3):
+    """
+    Generate count puzzles and return the throughput and the latency of
+    each puzzle.
+    """
+    latencies = []
+    timer = timeit.default_timer
+    start = last = timer()
+    for _ in sudoku.generate(count, seed, minimal, box_size):
+        now = timer()
+        latencies.append(now - last)
+        last = now
+    return _summarize(count, last - start, latencies)
+
+
+def bench_validate(puzzles):
+    """
+    Solve puzzles and then check the solutions one at a time with
+    validate() and as a batch with validate_many(), returning the
+    throughput of each along with the number of solutions that were not
+    valid.
+    """
+    solutions = list(result.solution for result in sudoku.solve_many(
+        puzzles, workers=1) if result.status == "solved")
+    timer = timeit.default_timer
+    latencies = []
+    invalid = 0
+    start = last = timer()
+    for solution in solutions:
+        if sudoku.validate(solution):
+            invalid += 1
+        now = timer()
+        latencies.append(now - last)
+        last = now
+    stats = _summarize(len(solutions), last - start, latencies)
+    stats["unsolved"] = invalid
+
+    grids = numpy.array(solutions, numpy.uint8)
+    start = timer()
+    sudoku.validate_many(grids)
+    batch = _summarize(len(solutions), timer() - start)
+    stats["batch_puzzles_per_second"] = batch["puzzles_per_second"]
+    return stats
+
+
+def _summarize(count, elapsed, latencies=None):
+    """
+    Return a dictionary with the number of puzzles, the elapsed time, the
+    throughput and, if latencies are given, latency percentiles in
+    milliseconds.
+    """
+    stats = {
+        "puzzles": count,
+        "seconds": elapsed,
+        "puzzles_per_second": count / elapsed if elapsed > 0 else None,
+    }
+    if latencies:
+        latencies = sorted(latencies)
+        for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            stats[name + "_ms"] = 1000*sudoku._percentile(
+                latencies, fraction)
+        stats["max_ms"] = 1000*latencies[-1]
+    return stats
+
+
+# benchmark functions by the kind of case they run
+_BENCHMARKS = {
+    "solve": bench_solve,
+    "solve_array": bench_solve_array,
+    "generate": bench_generate,
+    "validate": bench_validate,
+}
+
+
+def _run_case(case):
+    """
+    Run one (name, kind, arguments) case and return its statistics along
+    with the peak memory of the process that ran it.
+    """
+    name, kind, arguments = case
+    stats = _BENCHMARKS[kind](*arguments)
+    stats["name"] = name
+    stats["kind"] = kind
+    if resource is not None:
+        # kilobytes on Linux
+        stats["peak_memory_kb"] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+    else:
+        stats["peak_memory_kb"] = None
+    return stats
+
+
+def build_cases(corpora, engines=("dlx", "backtrack"), count=50, seed=0,
+                box_sizes=(2, 4, 5)):
+    """ Return the list of (name, kind, arguments) cases to run. """
+    cases = []
+    names = ["bundled", "17-clue", "known-hard", "unsolvable"]
+    names.extend(_DIFFICULTIES)
+    names.extend(sorted(name for name in corpora if name not in names))
+    for engine in engines:
+        for name in names:
+            if corpora.get(name):
+                cases.append(("solve/%s/%s" % (engine, name), "solve",
+                              (corpora[name], engine)))
+    nine_by_nine = list(puzzle for name in _DIFFICULTIES
+                        for puzzle in corpora.get(name, []))
+    if nine_by_nine:
+        cases.append(("solve_array/all", "solve_array", (nine_by_nine,)))
+        cases.append(("validate/all", "validate", (nine_by_nine,)))
+    cases.append(("generate/9x9", "generate", (count, seed)))
+    cases.append(("generate/9x9-minimal", "generate",
+                  (max(1, count // 5), seed, True)))
+    for box_size in box_sizes:
+        size = box_size*box_size
+        number = max(1, int(count*_SIZE_SCALE.get(box_size, 1)))
+        cases.append(("generate/%dx%d" % (size, size), "generate",
+                      (number, seed, False, box_size)))
+    return cases
+
+
+def run(cases, isolate=True):
+    """
+    Run each case and generate its statistics.  With isolate=True each case
+    runs in a new process so its peak memory is its own.
+    """
+    if not isolate:
+        for case in cases:
+            yield _run_case(case)
+        return
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for stats in pool.imap(_run_case, cases, 1):
+            yield stats
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare the throughput of each case in results with the case of the
+    same name in baseline, both lists of statistics, and return a list of
+    (name, ratio) tuples for the cases that slowed down by more than
+    tolerance, or that now leave more puzzles unsolved, with a ratio of
+    None for the latter.
+    """
+    before = dict((stats["name"], stats) for stats in baseline)
+    regressions = []
+    for stats in results:
+        old = before.get(stats["name"])
+        if old is None:
+            continue
+        if stats.get("unsolved", 0) > old.get("unsolved", 0):
+            regressions.append((stats["name"], None))
+        elif old["puzzles_per_second"] and stats["puzzles_per_second"]:
+            ratio = stats["puzzles_per_second"] / old["puzzles_per_second"]
+            if ratio < 1 - tolerance:
+                regressions.append((stats["name"], ratio))
+    return regressions
+
+
+def _format_stats(stats):
+    """ Make a one line report of the statistics of a case. """
+    text = "%-28s %6d puzzles %10.1f/s" % (
+        stats["name"], stats["puzzles"], stats["puzzles_per_second"] or 0)
+    if "p50_ms" in stats:
+        text += "  p50 %8.2f  p90 %8.2f  p99 %8.2f ms" % (
+            stats["p50_ms"], stats["p90_ms"], stats["p99_ms"])
+    if stats.get("peak_memory_kb") is not None:
+        text += "  %6.1f MB" % (stats["peak_memory_kb"] / 1024.0)
+    if stats.get("unsolved"):
+        text += "  %d unsolved" % stats["unsolved"]
+    return text
+
+
+def _main(arguments):
+    """ Run the benchmarks given on the command line. """
+    parser = argparse.ArgumentParser(
+        description="Benchmark solving, generating and validating Sudoku "
+        "puzzles and optionally compare the results with an earlier run.")
+    parser.add_argument("-o", "--output",
+                        help="write the results to this JSON file")
+    parser.add_argument("-b", "--baseline",
+                        help="JSON results of an earlier run to compare with")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.1,
+                        help="slowdown reported as a regression (default: "
+                        "0.1 for 10%%)")
+    parser.add_argument("-n", "--count", type=int, default=50,
+                        help="generated puzzles for each difficulty")
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("-e", "--engines", default="dlx,backtrack",
+                        help="comma separated engines to solve with")
+    parser.add_argument("--sizes", default="2,4,5",
+                        help="comma separated box sizes of larger grids, "
+                        "besides 9 by 9")
+    parser.add_argument("--no-isolate", action="store_true",
+                        help="run every case in this process")
+    options = parser.parse_args(arguments)
+
+    engines = tuple(options.engines.split(","))
+    box_sizes = tuple(int(size) for size in options.sizes.split(",") if size)
+    start = time.time()
+    corpora = build_corpora(options.count, options.seed, box_sizes)
+    sys.stderr.write("built corpora in %.1f s\n" % (time.time() - start))
+
+    results = []
+    cases = build_cases(corpora, engines, options.count, options.seed,
+                        box_sizes)
+    for stats in run(cases, not options.no_isolate):
+        print(_format_stats(stats))
+        sys.stdout.flush()
+        results.append(stats)
+
+    if options.output:
+        report = {
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "options": vars(options),
+            "corpora": dict((name, len(puzzles))
+                            for name, puzzles in corpora.items()),
+            "results": results,
+        }
+        with open(options.output, "w") as file_handle:
+            json.dump(report, file_handle, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as file_handle:
+            baseline = json.load(file_handle)["results"]
+        regressions = compare(results, baseline, options.tolerance)
+        for name, ratio in regressions:
+            if ratio is None:
+                print("REGRESSION %s: more puzzles unsolved" % name)
+            else:
+                print("REGRESSION %s: %.0f%% of baseline speed" % (
+                    name, 100*ratio))
+        return 1 if regressions else 0
+    return 0
+
+################################################################################
+# Main program
+################################################################################
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
@@ -3,62 +3,387 @@ Sudoku class for the Insight Data Engineering coding challenge.
 This class contains methods for generating and solving Sudoku puzzles as well
 as methods for reading and writing puzzles and solutions to and from csv files.
 
+numpy and multiprocessing are only imported when they are first used, by
+the Sudoku class, the whole array and packed file functions, or a pool of
+worker processes, so a command that solves a few puzzles starts quickly.
+
 Author: Jim Bridgewater
-Written for Python 2.7.8
+Written for Python 3
 """
 
 # import required libraries
+import argparse
+import array
+import collections
 import csv
-import numpy
+import importlib
+import itertools
+import json
+import os
 import random
+import struct
+import sys
+import time
+
+
+################################################################################
+# Lookup tables
+################################################################################
 
+# A grid is made of box_size by box_size regions, so it has size = box_size**2
+# rows, columns and regions, holds the numbers 1 to size, and has size**2
+# locations numbered from top left to bottom right, location = size*row +
+# column.  The standard puzzle has box_size 3.  Possible values are tracked as
+# bit masks where bit (value - 1) is set when value can still be entered in a
+# location.  The tables for each box size are held by a _Geometry.
+
+# the characters used for the numbers 1-35 in the one line puzzle format,
+# with "." for an empty location
+_SYMBOLS = ".123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# the number represented by each character in the one line puzzle format
+_SYMBOL_VALUES = dict((symbol, value) for value, symbol in enumerate(_SYMBOLS))
+_SYMBOL_VALUES.update(
+    (symbol.lower(), value) for value, symbol in enumerate(_SYMBOLS))
+_SYMBOL_VALUES["0"] = 0
+
+# the supported box sizes, indexed by the number of rows in a grid and by the
+# number of locations in a grid
+_BOX_SIZES = dict((box_size**2, box_size) for box_size in range(2, 6))
+_GRID_BOX_SIZES = dict((box_size**4, box_size) for box_size in range(2, 6))
+
+# the _Geometry for each box size that has been used, see _geometry()
+_GEOMETRIES = {}
+
+# the SolverStats being collected, or None when instrumentation is off, see
+# start_instrumentation()
+_STATS = None
+
+# the techniques used to enter numbers while solving, why each technique
+# allows a number to be entered, and the weight each move using it adds to a
+# puzzle's difficulty score
+_TECHNIQUE_REASONS = {
+    "naked single": "only possible value for this location",
+    "hidden single in region":
+        "only possible location for this value in region",
+    "hidden single in row":
+        "only possible location for this value in row",
+    "hidden single in column":
+        "only possible location for this value in column",
+}
+_TECHNIQUE_WEIGHTS = {
+    "naked single": 1,
+    "hidden single in region": 0,
+    "hidden single in row": 1,
+    "hidden single in column": 1,
+    # strategies that remove possible values, weighted for each time they
+    # make progress, see STRATEGIES
+    "pointing": 10,
+    "box-line reduction": 10,
+    "naked pair": 15,
+    "hidden pair": 20,
+    "naked triple": 25,
+    "hidden triple": 30,
+    "x-wing": 40,
+}
+
+# the weights each propagation round and each guess made by a search add to
+# a difficulty score, since every round is a step that depends on the ones
+# before it
+_ROUND_WEIGHT = 10
+_GUESS_WEIGHT = 20
+
+# the highest difficulty score for each difficulty below "expert"
+_DIFFICULTY_LIMITS = (("easy", 90), ("medium", 130), ("hard", 300))
+
+# the guesses counted towards a difficulty score, enough on their own for a
+# score above every limit
+_GRADED_GUESSES = _DIFFICULTY_LIMITS[-1][1] // _GUESS_WEIGHT + 1
+
+# a puzzle read by read_puzzles(): its position in the file, the number of its
+# first line, and either a list of 81 numbers or an error message
+PuzzleRecord = collections.namedtuple(
+    "PuzzleRecord", ["index", "line", "cells", "error"])
+
+# the result of solving one of the puzzles passed to solve_many()
+SolveResult = collections.namedtuple(
+    "SolveResult", ["index", "status", "solution", "trace"])
+
+# a hint returned by Sudoku.next_step(): digit can be entered at row and
+# column, numbered from 0, because of technique, within unit, a ("region",
+# "row" or "column", index) tuple, or None for a naked single, after the
+# eliminations of the named strategies
+Step = collections.namedtuple(
+    "Step", ["row", "column", "digit", "technique", "unit", "strategies"])
+
+# a symmetry of the grid, see canonical_form(): the grid is transposed if
+# transposed is true, then row i of the result is row rows[i], column j is
+# column columns[j], and each number v is replaced by labels[v]
+Transform = collections.namedtuple(
+    "Transform", ["transposed", "rows", "columns", "labels"])
+
+# the most arrangements of rows and columns canonical_form() compares before
+# settling for the best found so far.  Puzzles rarely tie on more than a few,
+# and each arrangement of a 9 by 9 grid costs about 20 microseconds, so
+# empty and completed grids are cut off after a few milliseconds.
+_CANONICAL_LIMIT = 128
+
+# The packed binary format starts with a header of _PACKED_HEADER fields:
+# the magic bytes, the format version, the box size of the grids, the bits
+# used for each location, a padding byte, and the number of grids.  Fixed
+# size records follow, one for each grid, with 4 bit locations packed two to
+# a byte, high bits first, or 8 bit locations that memory map to an
+# (N, locations) array with no copying.
+_PACKED_MAGIC = b"SDKP"
+_PACKED_VERSION = 1
+_PACKED_HEADER = struct.Struct("<4sBBBxQ")
 
 ################################################################################
-# Class definition
+# Class definitions
 ################################################################################
 
+class _LazyModule(object):
+    """
+    Stands in for a module until one of its attributes is first used, then
+    imports the module and puts it in place of itself in this module.
+    """
+
+    def __init__(self, name):
+        """ Stand in for the module called name. """
+        self._name = name
+
+
+    def __getattr__(self, attribute):
+        """ Import the module and return one of its attributes. """
+        module = importlib.import_module(self._name)
+        globals()[self._name] = module
+        return getattr(module, attribute)
+
+
+# modules that take long enough to import to slow down short runs
+numpy = _LazyModule("numpy")
+multiprocessing = _LazyModule("multiprocessing")
+
+
+class _Geometry(object):
+    """
+    Lookup tables for grids made of box_size by box_size regions.
+    """
+
+    def __init__(self, box_size):
+        """ Build the tables for grids with the given box size. """
+        size = box_size*box_size
+        self.box_size = box_size
+        self.size = size
+        self.locations = size*size
+
+        # mask with a bit set for each of the values 1 to size
+        self.all_values = (1 << size) - 1
+
+        # the array type code that holds a mask
+        self.mask_type = "H" if size <= 16 else "L"
+
+        # the values and the number of values contained in each mask, as
+        # tables when they are small enough
+        if size <= 9:
+            self.mask_values = list(
+                tuple(value for value in range(1, size + 1)
+                      if mask & (1 << (value - 1)))
+                for mask in range(self.all_values + 1))
+            self.mask_size = list(len(values) for values in self.mask_values)
+        else:
+            self.mask_values = _MaskValues()
+            self.mask_size = _MaskSize()
+
+        # the row, column and region containing each location
+        locations = range(self.locations)
+        self.row = list(location // size for location in locations)
+        self.column = list(location % size for location in locations)
+        self.region = list(
+            box_size*(self.row[location] // box_size) +
+            self.column[location] // box_size for location in locations)
+
+        # the locations contained in each row, column and region
+        self.row_locations = list(
+            list(location for location in locations if self.row[location] == i)
+            for i in range(size))
+        self.column_locations = list(
+            list(location for location in locations
+                 if self.column[location] == i)
+            for i in range(size))
+        self.region_locations = list(
+            list(location for location in locations
+                 if self.region[location] == i)
+            for i in range(size))
+        self.units = (self.region_locations + self.row_locations +
+                      self.column_locations)
+
+        # the locations that share a row, column, or region with each location
+        self.peers = list(
+            tuple(sorted(set(
+                self.row_locations[self.row[location]] +
+                self.column_locations[self.column[location]] +
+                self.region_locations[self.region[location]]) -
+                set([location])))
+            for location in locations)
+
+        # the intersection of each row and each column with each region it
+        # crosses, as (segment, rest of line, rest of region) tuples of
+        # locations
+        self.intersections = []
+        for lines in (self.row_locations, self.column_locations):
+            for line in lines:
+                regions = set(self.region[location] for location in line)
+                for region in sorted(regions):
+                    segment = tuple(
+                        location for location in line
+                        if self.region[location] == region)
+                    self.intersections.append((
+                        segment,
+                        tuple(location for location in line
+                              if location not in segment),
+                        tuple(location
+                              for location in self.region_locations[region]
+                              if location not in segment)))
+
+        # the exact cover constraints satisfied by entering value at
+        # location, indexed by size*location + value - 1: the location is
+        # filled and value appears in its row, column, and region
+        count = self.locations
+        self.choice_constraints = list(
+            (location,
+             count + size*self.row[location] + value,
+             2*count + size*self.column[location] + value,
+             3*count + size*self.region[location] + value)
+            for location in locations for value in range(size))
+
+
+class _MaskSize(object):
+    """ Counts the values in masks too wide for a lookup table. """
+
+    def __getitem__(self, mask):
+        """ Return the number of values in mask. """
+        return bin(mask).count("1")
+
+
+class _MaskValues(object):
+    """ Lists the values in masks too wide for a lookup table. """
+
+    def __getitem__(self, mask):
+        """ Return a tuple of the values in mask. """
+        values = []
+        while mask:
+            bit = mask & -mask
+            values.append(bit.bit_length())
+            mask ^= bit
+        return tuple(values)
+
+
 class Sudoku(object):
     """ Sudoku class for the Insight Data Engineering coding challenge """
 
-    def __init__(self):
+    __slots__ = ("_geometry", "_puzzle", "_solution", "_state", "_trace",
+                 "_moves")
+
+    def __init__(self, box_size=3):
         """
         Sudoku class constructor that initializes arrays for the puzzle, the
         puzzle's solution, and other internal data structures used to create
-        and solve Sudoku puzzles.
+        and solve Sudoku puzzles.  The grid is made of box_size by box_size
+        regions, so box_size=3 gives the standard 9 by 9 puzzle and
+        box_size=2, 4 or 5 give 4 by 4, 16 by 16 or 25 by 25 puzzles.
         """
 
+        # lookup tables for the size of the grid
+        self._geometry = _geometry(box_size)
+        size = self._geometry.size
+
         # puzzle values
-        self._puzzle = numpy.zeros([9, 9], numpy.int)
+        self._puzzle = numpy.zeros([size, size], numpy.uint8)
 
         # solution values
-        self._solution = numpy.zeros([9, 9], numpy.int)
+        self._solution = numpy.zeros([size, size], numpy.uint8)
 
         # the values that can be entered in each location
         # without duplicating any of the numbers in the
         # row, column, or region that contain that location
-        self._possible_values = list(
-            [[[i + 1 for i in range(9)] for j in range(9)] for k in range(9)])
+        self._state = _GridState(geometry=self._geometry)
 
-        # the number of values that can be entered in each location
-        # without duplicating any of the numbers in the
-        # row, column, or region that contain that location
-        self._possibilities = 9*numpy.ones([9, 9], numpy.int)
+        # how the last call to solve() found the solution
+        self._trace = None
+
+        # a (trail mark, row, column) for each move that undo() can revert
+        self._moves = []
+
+
+    @property
+    def _possible_values(self):
+        """
+        A nested list with the values that can be entered in each location
+        without duplicating any of the numbers in the row, column, or region
+        that contain that location.
+        """
+        candidates = self._state.candidates
+        mask_values = self._geometry.mask_values
+        size = self._geometry.size
+        return list(
+            list(list(mask_values[candidates[size*i + j]])
+                 for j in range(size))
+            for i in range(size))
+
+
+    @property
+    def _possibilities(self):
+        """
+        A nested list with the number of values that can be entered in each
+        location without duplicating any of the numbers in the row, column,
+        or region that contain that location.
+        """
+        candidates = self._state.candidates
+        mask_size = self._geometry.mask_size
+        size = self._geometry.size
+        return list(
+            list(mask_size[candidates[size*i + j]] for j in range(size))
+            for i in range(size))
 
 
     def _get_possible_values(self, location):
         """
-        Returns a list of possible values for a location in the Sudoku grid and
-        provides indexing with tuples.
+        Returns a tuple of possible values for a location in the Sudoku grid
+        and provides indexing with tuples.
         """
         row = location[0]
         column = location[1]
-        return self._possible_values[row][column]
+        return self._geometry.mask_values[
+            self._state.candidates[self._geometry.size*row + column]]
+
+
+    def _place(self, location, value):
+        """
+        Enter value at location (numbered from 0 at the top left) in the
+        solution and remove it from the possible values of the locations that
+        share its row, column, or region.
+        """
+        self._state.place(location, value)
+        self._solution[self._geometry.row[location],
+                       self._geometry.column[location]] = value
+
+
+    def _erase(self, location):
+        """
+        Remove the value at location (numbered from 0 at the top left) from
+        the solution and recompute the possible values of that location and
+        its peers.
+        """
+        self._state.remove(location)
+        self._solution[self._geometry.row[location],
+                       self._geometry.column[location]] = 0
 
 
     def _rows(self):
         """
-        Return a list of nine arrays which contain the entries in each of
-        the nine rows in the solution to the Sudoku puzzle.
+        Return a list of arrays which contain the entries in each of the
+        rows in the solution to the Sudoku puzzle.
         """
         rows = list(row for row in self._solution)
         return rows
@@ -66,8 +391,8 @@ class Sudoku(object):
 
     def _columns(self):
         """
-        Return a list of nine arrays which contain the entries in each of
-        the nine columns in the solution to the Sudoku puzzle.
+        Return a list of arrays which contain the entries in each of the
+        columns in the solution to the Sudoku puzzle.
         """
         columns = list(column for column in numpy.transpose(self._solution))
         return columns
@@ -75,18 +400,26 @@ class Sudoku(object):
 
     def _regions(self):
         """
-        Return a list of nine arrays which contain the entries in each of
-        the nine 3 by 3 regions in the solution to the Sudoku puzzle.
+        Return a list of arrays which contain the entries in each of the
+        regions in the solution to the Sudoku puzzle.
         """
+        box_size = self._geometry.box_size
+        size = self._geometry.size
+        corners = range(0, size, box_size)
         regions = list(
-            self._solution[i:i+3, j:j+3] for i in [0, 3, 6] for j in [0, 3, 6])
-        for i in range(9):
-            regions[i] = regions[i].reshape(1, 9)[0]
+            self._solution[i:i+box_size, j:j+box_size]
+            for i in corners for j in corners)
+        for i in range(size):
+            regions[i] = regions[i].reshape(1, size)[0]
         return regions
 
 
     def puzzle_from_csv(self, file_name):
-        """ Read a Sudoku puzzle from a file of comma separated values. """
+        """
+        Read a Sudoku puzzle from a file of comma separated values.  The
+        number of columns in the file sets the size of the grid.  Raises
+        ValueError for a number outside 0 to the size of the grid.
+        """
 
         try:
             file_handle = open(file_name)
@@ -94,74 +427,77 @@ class Sudoku(object):
             data_list = []
             for line in csvreader:
                 row = list(int(i) for i in line)
-                assert len(row) == 9, "wrong number of columns in " + file_name
                 data_list.append(row)
+            size = len(data_list[0])
+            assert size in _BOX_SIZES, \
+                "wrong number of columns in " + file_name
+            for row in data_list:
+                assert len(row) == size, \
+                    "wrong number of columns in " + file_name
         except:
             exit("There was a problem reading " + file_name)
-        assert len(data_list) == 9, "wrong number of rows in " + file_name
-        self._puzzle = numpy.array(data_list)
-        self._solution = numpy.array(data_list)
+        assert len(data_list) == size, "wrong number of rows in " + file_name
+        # checked as the other readers do, since numpy would refuse a
+        # negative number and keep a number that is too large
+        for row in data_list:
+            for value in row:
+                if value < 0 or value > size:
+                    raise ValueError("entries must be 0-" + str(size) +
+                                     ", found " + str(value))
+        self._geometry = _geometry(_BOX_SIZES[size])
+        self._puzzle = numpy.array(data_list, numpy.uint8)
+        self._solution = self._puzzle.copy()
         self._update_possible_values()
-        print "Sudoku puzzle read from " + file_name
+        print("Sudoku puzzle read from " + file_name)
 
 
     def _update_possible_values(self):
         """
-        Updates all entries in _possible_values and _possibilities
-        after changes to _solution.
+        Rebuilds the possible values for every location after changes to
+        _solution that were not made with place() or erase().  Moves made
+        before can no longer be undone.
         """
-        for i in range(9):
-            for j in range(9):
-                possible_values = self._find_possible_values(i, j)
-                self._possible_values[i][j] = possible_values
-                self._possibilities[i][j] = len(possible_values)
+        if _STATS is not None:
+            _STATS.calls["_update_possible_values"] += 1
+        self._state = _GridState(
+            self._solution.flatten().tolist(), self._geometry)
+        self._moves = []
 
 
     def _find_possible_values(self, row, column):
         """
         Returns a list of the possible values a grid location can take without
-        duplicating any of the values in its row, column, or 3 by 3 region.
+        duplicating any of the values in its row, column, or region.
         """
-        if self._solution[row, column] in [1, 2, 3, 4, 5, 6, 7, 8, 9]:
-            # this location already contains a value, no more choices
-            possible_values = []
-        else:
-            # this location is empty
-            possible_values = [1, 2, 3, 4, 5, 6, 7, 8, 9]
-        constraining_locations = _constraining_locations(row, column)
-        for i in range(9):
-            for j in range(9):
-                if constraining_locations[i, j] == 1:
-                    # remove values found in the row, column and region
-                    value = self._solution[i, j]
-                    if value in possible_values:
-                        possible_values.remove(value)
-        return possible_values
+        if _STATS is not None:
+            _STATS.calls["_find_possible_values"] += 1
+        return list(self._geometry.mask_values[
+            self._state.candidates[self._geometry.size*row + column]])
 
 
     def print_puzzle(self):
         """ Print the Sudoku puzzle. """
-        print
-        print "Sudoku puzzle:"
-        print
+        print()
+        print("Sudoku puzzle:")
+        print()
         _print_grid(self._puzzle)
 
 
     def print_solution(self):
         """ Print the Sudoku puzzle's solution. """
         if self._valid_solution():
-            print
-            print "Sudoku solution:"
-            print
+            print()
+            print("Sudoku solution:")
+            print()
             _print_grid(self._solution)
         else:
-            print "The Sudoku puzzle has not been solved!"
+            print("The Sudoku puzzle has not been solved!")
 
 
     def write_puzzle_to_csv(self, file_name):
         """ Write the Sudoku puzzle to a file of comma separated values. """
         _grid_to_csv(self._puzzle, file_name)
-        print "Puzzle written to " + file_name
+        print("Puzzle written to " + file_name)
 
 
     def write_solution_to_csv(self, file_name):
@@ -170,7 +506,7 @@ class Sudoku(object):
         """
         if self._valid_solution():
             _grid_to_csv(self._solution, file_name)
-            print "Solution written to " + file_name
+            print("Solution written to " + file_name)
         else:
             error_message = "Data for " + file_name + \
             " is not a valid Sudoku solution."
@@ -179,40 +515,15 @@ class Sudoku(object):
 
     def _valid_solution(self):
         """ Test the validity of a proposed Sudoku solution. """
-        # check rows
-        for row in self._rows():
-            for entry in row:
-                # all entries must be 1-9
-                if entry not in [1, 2, 3, 4, 5, 6, 7, 8, 9]:
-                    return False
-                # all entries in a row must be unique
-                if sum(list(int(i == entry) for i in row)) > 1:
-                    return False
-
-        # check columns
-        for column in self._columns():
-            for entry in column:
-                # all entries must be 1-9
-                if entry not in [1, 2, 3, 4, 5, 6, 7, 8, 9]:
-                    return False
-                # all entries in a column must be unique
-                if sum(list(int(i == entry) for i in column)) > 1:
-                    return False
-
-        # check 3 by 3 regions
-        for region in self._regions():
-            for entry in region:
-                # all entries must be 1-9
-                if entry not in [1, 2, 3, 4, 5, 6, 7, 8, 9]:
-                    return False
-                # all entries in a region must be unique
-                if sum(list(int(i == entry) for i in region)) > 1:
-                    return False
-
-        return True
+        try:
+            return not validate(self._solution)
+        except ValueError:
+            # some entries are out of range
+            return False
 
 
-    def solve(self, verbose=True):
+    def solve(self, verbose=True, engine="propagate", strategies=(),
+              seconds=None, nodes=None):
         """ Solve the Sudoku puzzle. """
         """
         Start by searching for empty locations that have only one possible
@@ -221,182 +532,252 @@ class Sudoku(object):
         possible values in a single row, column, or region location.  Add
         those values and update possible_values.  Repeat this process until
         nothing more is found.
+
+        With engine="backtrack" or engine="dlx" any locations that are still
+        empty are then filled by a complete search, so the puzzle is either
+        solved or shown to have no solution.  "backtrack" guesses values for
+        the location with the fewest possible values and repeats the process
+        above after each guess, "dlx" solves the remaining exact cover problem
+        with Knuth's Algorithm X.
+
+        strategies names extra techniques from STRATEGIES, or "all", that
+        are tried whenever the search above stalls.  They remove possible
+        values rather than enter numbers, so they need fewer guesses on hard
+        puzzles at some cost in time on easy ones.
+
+        seconds and nodes limit the time and the number of values tried by
+        the search, see Budget.  When either runs out the search stops, the
+        solution is left as far as propagation got, and the trace status is
+        "budget exceeded".
         """
-        if not self._puzzle_solvable():
-            print "This is not a valid Sudoku puzzle and cannot be solved!"
+        if engine not in _ENGINES:
+            raise ValueError("unknown engine " + repr(engine))
+        strategies = _strategy_names(strategies)
+
+        self._trace = SolveTrace()
+        self._state.trail = None
+        self._moves = []
+        status, self._state = _solve_state(self._state, engine, self._trace,
+                                           strategies,
+                                           _budget(seconds, nodes))
+        if status == "invalid":
+            print("This is not a valid Sudoku puzzle and cannot be solved!")
             return False
-
-        keep_going = True
-        while keep_going:
-            keep_going = False
-
-            # enter numbers in locations that have only one possible value
-            for i in range(9):
-                for j in range(9):
-                    if self._possibilities[i][j] == 1:
-                        # found a location with only one possible value
-                        keep_going = True
-                        only_possible_value = self._possible_values[i][j][0]
-                        self._solution[i][j] = only_possible_value
-                        if verbose:
-                            print "Adding", only_possible_value,
-                            print "at row", i + 1, "column", j + 1,
-                            print "- only possible value for this location"
-            self._update_possible_values()
-
-            # enter numbers that are possible values in a single location
-            # in a 3 by 3 region
-            for region in range(9):
-                # for each region build a list of possible values
-                locations = []
-                region_list = []
-                for row in _region_row_range(region):
-                    for column in _region_column_range(region):
-                        locations.append((row, column))
-                        possible_values = self._possible_values[row][column]
-                        region_list.extend(possible_values)
-                # if a number is in the list only once add it
-                # in the only location possible
-                for number in range(1, 10):
-                    if region_list.count(number) == 1:
-                        # found a number that can only go in one location
-                        keep_going = True
-                        for location in locations:
-                            possible_values = self._get_possible_values(location)
-                            if number in possible_values:
-                                self._solution[location] = number
-                                if verbose:
-                                    print "Adding", number,
-                                    print "at row", location[0] + 1,
-                                    print "column", location[1] + 1,
-                                    print "- only possible location for this",
-                                    print "value in region"
-            self._update_possible_values()
-
-            # enter numbers that are possible values in a
-            # single location in a row
-            for row in range(9):
-                # for each row build a list of possible values so we can see
-                # how many times each number occurs
-                locations = []
-                row_list = []
-                for column in range(9):
-                    locations.append((row, column))
-                    possible_values = self._possible_values[row][column]
-                    row_list.extend(possible_values)
-                # if a number is in the list only once add it
-                # in the only location possible
-                for number in range(1, 10):
-                    if row_list.count(number) == 1:
-                        # found a number that can only go in one location
-                        keep_going = True
-                        for location in locations:
-                            possible_values = self._get_possible_values(location)
-                            if number in possible_values:
-                                self._solution[location] = number
-                                if verbose:
-                                    print "Adding", number,
-                                    print "at row", location[0] + 1,
-                                    print "column", location[1] + 1,
-                                    print "- only possible location for this",
-                                    print "value in row"
-            self._update_possible_values()
-
-
-            # enter numbers that are possible values in a
-            # single location in a column
-            for column in range(9):
-                # for each column build a list of possible values so we can see
-                # how many times each number occurs
-                locations = []
-                column_list = []
-                for row in range(9):
-                    locations.append((row, column))
-                    possible_values = self._possible_values[row][column]
-                    column_list.extend(possible_values)
-                # if a number is in the list only once add it
-                # in the only location possible
-                for number in range(1, 10):
-                    if column_list.count(number) == 1:
-                        # found a number that can only go in one location
-                        keep_going = True
-                        for location in locations:
-                            possible_values = self._get_possible_values(location)
-                            if number in possible_values:
-                                self._solution[location] = number
-                                if verbose:
-                                    print "Adding", number,
-                                    print "at row", location[0] + 1,
-                                    print "column", location[1] + 1,
-                                    print "- only possible location for this",
-                                    print "value in column"
-            self._update_possible_values()
-
-        if 0 in self._solution:
+        size = self._geometry.size
+        if verbose:
+            for location, value, technique in self._trace.moves:
+                _print_move(location, value, technique, size)
+        self._solution[:, :] = numpy.array(
+            self._state.cells).reshape(size, size)
+
+        if status == "unsolvable":
+            if verbose:
+                print()
+                print("This Sudoku puzzle has no solution!")
+            return False
+        elif status in ("unfinished", "budget exceeded"):
             # there are still empty locations in the solution
             if verbose:
-                print
-                print "Unable to completely solve this Sudoku puzzle!"
-                print
-                print "This is as far as I got:"
-                print
+                print()
+                if status == "budget exceeded":
+                    print("Ran out of time solving this Sudoku puzzle!")
+                else:
+                    print("Unable to completely solve this Sudoku puzzle!")
+                print()
+                print("This is as far as I got:")
+                print()
                 _print_grid(self._solution)
             return False
         else:
             return True
 
 
-    def new_puzzle(self):
+    def new_puzzle(self, seed=None, minimal=False, seconds=None,
+                   nodes=None):
         """ Generate a new Sudoku puzzle. """
         """
         Do this by generating a new solution from scratch and then removing
-        numbers to make a puzzle.
-        """
-        print "Generating a new Sudoku puzzle"
-        self._new_solution()
-
-        # remove numbers from the solution until the puzzle is unsolvable
-        locations = [(i, j) for i in range(9) for j in range(9)]
-        solvable = True
-        while solvable:
-            location = random.choice(locations)
-            last_number_removed = self._solution[location]
-            self._puzzle[location] = 0
-            # have to update solution too to loop with solve()
-            self._solution[:, :] = self._puzzle[:, :]
-            self._update_possible_values()
-            locations.remove(location)
-            solvable = self.solve(verbose=False)
-
-        # put back the last number removed so the puzzle can be solved
-        self._puzzle[location] = last_number_removed
-        self._solution[:, :] = self._puzzle[:, :]
+        numbers in a random order, putting back each number whose removal
+        would stop solve() from finishing the puzzle.  A puzzle that solve()
+        can finish has exactly one solution.  With minimal=True numbers are
+        then removed for as long as the solution stays unique, leaving a
+        puzzle that needs every one of its numbers but may need a search to
+        solve.  Passing the same seed generates the same puzzle.
+
+        seconds and nodes limit the work done, as for solve().  Returns
+        True, or False if the budget ran out, leaving the puzzle as it was.
+        """
+        print("Generating a new Sudoku puzzle")
+        rng = random if seed is None else random.Random(seed)
+        budget = _budget(seconds, nodes)
+        try:
+            solution = _random_solution(rng, self._geometry, budget)
+            puzzle = _dig_holes(solution, rng, minimal, budget)
+        except BudgetExceeded as error:
+            print("Unable to generate a puzzle:", error)
+            return False
+        size = self._geometry.size
+        self._puzzle = numpy.array(puzzle, numpy.uint8).reshape(size, size)
+        self._solution = self._puzzle.copy()
         self._update_possible_values()
+        self._trace = None
+        return True
+
+
+    @property
+    def trace(self):
+        """
+        The SolveTrace recorded by the last call to solve(), which tells how
+        the puzzle was solved and how difficult it is, or None.
+        """
+        return self._trace
 
 
-    def _new_solution(self):
-        """ Generate a Sudoku solution from scratch. """
-        self.__init__()
-        row = 0
-        while row < 9:
-            column = 0
-            while column < 9:
-                # enter one of the possible values in this location
-                possible_values = self._possible_values[row][column]
-                self._puzzle[row, column] = random.choice(possible_values)
-                self._solution[row, column] = self._puzzle[row, column]
-                self._update_possible_values()
-                if self._puzzle_solvable():
-                    # the puzzle is still solvable so move to the next location
-                    column = column + 1
+    def count_solutions(self, limit=2, engine="dlx"):
+        """
+        Count the solutions of the puzzle, stopping once limit solutions
+        have been found, so count_solutions() == 1 shows that a puzzle has a
+        unique solution without enumerating every solution of a bad one.
+        """
+        if engine not in _ENGINES or _ENGINES[engine] is None:
+            raise ValueError("cannot count solutions with " + repr(engine))
+        state = _GridState(self._puzzle.flatten().tolist(), self._geometry)
+        return _count_solutions(state, limit, engine)
+
+
+    def place(self, row, column, digit):
+        """
+        Enter digit at a location of the solution, replacing any number
+        entered there before, and update the possible values of the
+        locations that share its row, column, or region.  Rows and columns
+        are numbered from 0.  Returns False, changing nothing, if digit is
+        already in that row, column, or region.  Raises ValueError for a
+        location or digit outside the grid or a location given in the
+        puzzle.  The move can be reverted with undo().
+        """
+        location = self._location(row, column)
+        if not 1 <= digit <= self._geometry.size:
+            raise ValueError("no digit %r in a %d by %d grid" % (
+                digit, self._geometry.size, self._geometry.size))
+        state = self._state
+        geometry = self._geometry
+        if state.cells[location] == digit:
+            return True
+        # the number entered here now, if any, is a different digit, so the
+        # unit masks only have digit if a peer holds it
+        if (state.row_masks[geometry.row[location]] |
+                state.column_masks[geometry.column[location]] |
+                state.region_masks[geometry.region[location]]) & \
+                (1 << (digit - 1)):
+            return False
+        mark = state.mark()
+        state.remove(location)
+        state.place(location, digit)
+        self._solution[row, column] = digit
+        self._moves.append((mark, row, column))
+        return True
+
+
+    def erase(self, row, column):
+        """
+        Empty a location of the solution and give the locations that share
+        its row, column, or region back the possible value it held.
+        Returns False if the location was already empty.  Raises ValueError
+        as place() does.  The move can be reverted with undo().
+        """
+        location = self._location(row, column)
+        state = self._state
+        if not state.cells[location]:
+            return False
+        mark = state.mark()
+        state.remove(location)
+        self._solution[row, column] = 0
+        self._moves.append((mark, row, column))
+        return True
+
+
+    def undo(self):
+        """
+        Revert the last move made by place() or erase().  Returns False if
+        there is no move to revert.
+        """
+        if not self._moves:
+            return False
+        mark, row, column = self._moves.pop()
+        self._state.undo(mark)
+        self._solution[row, column] = \
+            self._state.cells[self._geometry.size*row + column]
+        return True
+
+
+    def candidates(self, row, column):
+        """
+        Return a list of the digits that can be entered at a location
+        without duplicating a number in its row, column, or region, which
+        is empty for a location that holds a number.  Raises ValueError for
+        a location outside the grid.
+        """
+        self._location(row, column, given=True)
+        return self._find_possible_values(row, column)
+
+
+    def next_step(self, strategies=()):
+        """
+        Return the next number solve() would enter as a Step, without
+        entering it, or None if no technique finds one.  The search stops
+        at the first number found: naked singles are looked for first and
+        then hidden singles in regions, rows, and columns.  If there are
+        none, the strategies named, see STRATEGIES, remove possible values
+        from a copy of the grid until a single appears, and the Step lists
+        the strategies that were needed.
+        """
+        strategies = _strategy_names(strategies)
+        state = self._state
+        found = state.next_single()
+        used = []
+        if found is None and strategies:
+            state = state.copy()
+            while found is None:
+                for name in strategies:
+                    if _STRATEGY_FUNCTIONS[name](state):
+                        used.append(name)
+                        break
                 else:
-                    # the puzzle has become unsolvable so retry this row
-                    for column in range(9):
-                        self._puzzle[row, column] = 0
-                        self._solution[row, column] = 0
-                    self._update_possible_values()
-                    column = 0
-            row = row + 1
+                    break
+                found = state.next_single()
+        if found is None:
+            return None
+        location, value, technique, unit = found
+        size = self._geometry.size
+        return Step(location // size, location % size, value, technique,
+                    unit, tuple(used))
+
+
+    def is_solvable(self):
+        """
+        Determine if the solution entered so far might still be finished,
+        with the checks of _puzzle_solvable().  A False answer is certain.
+        The check of each row, column, and region on its own is exact, but
+        the units are checked one at a time, so some grids with no solution
+        still pass, see count_solutions() for an exact answer.
+        """
+        return self._puzzle_solvable()
+
+
+    def _location(self, row, column, given=False):
+        """
+        Return the location of a row and column of the grid that was not
+        given in the puzzle, or of any row and column with given=True,
+        raising ValueError otherwise.
+        """
+        size = self._geometry.size
+        if not (0 <= row < size and 0 <= column < size):
+            raise ValueError("no location at row %r column %r in a %d by %d "
+                             "grid" % (row, column, size, size))
+        if not given and self._puzzle[row, column]:
+            raise ValueError("row %d column %d is given in the puzzle" % (
+                row, column))
+        return size*row + column
 
 
     def _puzzle_solvable(self):
@@ -405,91 +786,939 @@ class Sudoku(object):
         there is a unique value available for every location in
         each row, column, and region.
         """
+        if _STATS is not None:
+            _STATS.calls["_puzzle_solvable"] += 1
+        return self._state.solvable()
 
-        # check the rows to make sure there is still a unique choice available
-        # for each empty location in the row
-        for row in range(9):
-            row_lists = self._possible_values[row]
-            row_lists = [
-                self._possible_values[row][column]
-                for column in range(9)
-                if self._solution[row][column] == 0
-            ]
-            if not _unique_choice(row_lists):
-                return False
 
-        # check the regions to make sure there is still a unique choice
-        # available for each empty location in the region
-        for region in range(9):
-            region_lists = [
-                self._possible_values[row][column]
-                for row in _region_row_range(region)
-                for column in _region_column_range(region)
-                if self._solution[row][column] == 0
-            ]
-            if not _unique_choice(region_lists):
-                return False
+class _GridState(object):
+    """
+    Entries and possible values of a Sudoku grid stored as bit masks so that
+    entering or removing a number only touches the locations that share a
+    row, column, or region with it.  The entries and the masks of each unit
+    are held in arrays of bytes and words, and the possible values in a list
+    because reading a list is much faster in the inner loops of
+    propagate().  Copying a state makes a fixed number of small allocations,
+    and pack() turns a state into a few hundred bytes for storage.
+
+    Changes can be recorded on a trail and undone: mark() starts recording
+    and returns a position on the trail, and undo() reverts every change
+    made by place(), exclude() and remove() since then.
+    """
+
+    __slots__ = ("geometry", "cells", "row_masks", "column_masks",
+                 "region_masks", "candidates", "conflicts", "trail")
+
+    def __init__(self, cells=None, geometry=None):
+        """
+        Build the possible values for a grid given as a list of numbers, with
+        zeros for empty locations, or for an empty grid.  The size of the
+        grid is taken from geometry, from the length of cells, or is 9 by 9.
+        """
+        if geometry is None:
+            geometry = _geometry_for(cells)
+        size = geometry.size
+
+        # lookup tables for the size of the grid
+        self.geometry = geometry
+
+        # the number entered in each location, 0 if the location is empty
+        self.cells = array.array("B", [0])*geometry.locations
+
+        # the numbers already entered in each row, column, and region
+        self.row_masks = array.array(geometry.mask_type, [0])*size
+        self.column_masks = self.row_masks[:]
+        self.region_masks = self.row_masks[:]
+
+        # the numbers that can still be entered in each location
+        self.candidates = [geometry.all_values]*geometry.locations
+
+        # true if a number was entered twice in a row, column, or region
+        self.conflicts = False
+
+        # the changes that undo() can revert, None until mark() is called
+        self.trail = None
+
+        if cells is not None:
+            row = geometry.row
+            column = geometry.column
+            region = geometry.region
+            for location, value in enumerate(cells):
+                if value:
+                    bit = 1 << (value - 1)
+                    if (self.row_masks[row[location]] |
+                            self.column_masks[column[location]] |
+                            self.region_masks[region[location]]) & bit:
+                        self.conflicts = True
+                    self.cells[location] = value
+                    self.row_masks[row[location]] |= bit
+                    self.column_masks[column[location]] |= bit
+                    self.region_masks[region[location]] |= bit
+            for location in range(geometry.locations):
+                self._refresh(location)
+
+
+    def _refresh(self, location):
+        """ Recompute the possible values for location from the unit masks. """
+        if self.cells[location]:
+            self.candidates[location] = 0
+        else:
+            geometry = self.geometry
+            self.candidates[location] = geometry.all_values & ~(
+                self.row_masks[geometry.row[location]] |
+                self.column_masks[geometry.column[location]] |
+                self.region_masks[geometry.region[location]])
+
+
+    def place(self, location, value):
+        """ Enter value at location and update its peers' possible values. """
+        geometry = self.geometry
+        bit = 1 << (value - 1)
+        self.cells[location] = value
+        self.row_masks[geometry.row[location]] |= bit
+        self.column_masks[geometry.column[location]] |= bit
+        self.region_masks[geometry.region[location]] |= bit
+        candidates = self.candidates
+        if self.trail is not None:
+            # the old mask of location and the peers that lose value
+            self.trail.append(("place", location, value, (
+                candidates[location],) + tuple(
+                    peer for peer in geometry.peers[location]
+                    if candidates[peer] & bit)))
+        candidates[location] = 0
+        keep = ~bit
+        for peer in geometry.peers[location]:
+            candidates[peer] &= keep
+
+
+    def exclude(self, location, value):
+        """ Remove value from the possible values of an empty location. """
+        bit = 1 << (value - 1)
+        if self.trail is not None and self.candidates[location] & bit:
+            self.trail.append(("exclude", location, value, None))
+        self.candidates[location] &= ~bit
+
+
+    def copy(self):
+        """
+        Return an independent copy of this grid state, without the trail.
+        """
+        other = _GridState.__new__(_GridState)
+        other.geometry = self.geometry
+        other.cells = self.cells[:]
+        other.row_masks = self.row_masks[:]
+        other.column_masks = self.column_masks[:]
+        other.region_masks = self.region_masks[:]
+        other.candidates = self.candidates[:]
+        other.conflicts = self.conflicts
+        other.trail = None
+        return other
+
+
+    def pack(self):
+        """
+        Return the entries and possible values of the state as a string of
+        bytes, 243 for a 9 by 9 grid, that unpack() turns back into a state.
+        """
+        return (self.cells.tobytes() + array.array(
+            self.geometry.mask_type, self.candidates).tobytes())
+
+
+    @staticmethod
+    def unpack(data, geometry=None):
+        """ Return the state packed into data by pack(). """
+        if geometry is None:
+            geometry = _geometry(3)
+        cells = array.array("B")
+        cells.frombytes(data[:geometry.locations])
+        candidates = array.array(geometry.mask_type)
+        candidates.frombytes(data[geometry.locations:])
+        state = _GridState(cells, geometry)
+        state.candidates = candidates.tolist()
+        return state
+
+
+    def mark(self):
+        """
+        Start recording changes if they are not being recorded already and
+        return the current position on the trail, to pass to undo().
+        """
+        if self.trail is None:
+            self.trail = []
+        return len(self.trail)
+
+
+    def undo(self, mark=None):
+        """
+        Revert the changes recorded since mark was returned by mark(), or
+        the last recorded change if mark is None.  Returns the number of
+        changes reverted.
+        """
+        trail = self.trail
+        if not trail:
+            return 0
+        if mark is None:
+            mark = len(trail) - 1
+        geometry = self.geometry
+        candidates = self.candidates
+        reverted = 0
+        while len(trail) > mark:
+            change, location, value, saved = trail.pop()
+            bit = 1 << (value - 1)
+            if change == "exclude":
+                candidates[location] |= bit
+            elif change == "place":
+                keep = ~bit
+                self.cells[location] = 0
+                self.row_masks[geometry.row[location]] &= keep
+                self.column_masks[geometry.column[location]] &= keep
+                self.region_masks[geometry.region[location]] &= keep
+                candidates[location] = saved[0]
+                for peer in saved[1:]:
+                    candidates[peer] |= bit
+            else:
+                self.cells[location] = value
+                self.row_masks[geometry.row[location]] |= bit
+                self.column_masks[geometry.column[location]] |= bit
+                self.region_masks[geometry.region[location]] |= bit
+                candidates[location] = 0
+                for peer, mask in zip(geometry.peers[location], saved):
+                    candidates[peer] = mask
+            reverted += 1
+        return reverted
+
+
+    def solvable(self):
+        """
+        Determine if the grid might have a solution by ensuring that no
+        number was entered twice in a row, column, or region and that
+        unique values can be chosen for the empty locations of each row,
+        column, and region, see _unique_choice().  Each unit is checked
+        exactly, but on its own, so passing does not ensure a solution.
+        """
+        if _STATS is not None:
+            _STATS.calls["_GridState.solvable"] += 1
+        if self.conflicts:
+            return False
+
+        candidates = self.candidates
+        cells = self.cells
+        geometry = self.geometry
+        for units in (geometry.row_locations, geometry.region_locations,
+                      geometry.column_locations):
+            # check each unit to make sure there is still a unique choice
+            # available for each empty location in the unit
+            for unit in units:
+                unit_masks = [
+                    candidates[location]
+                    for location in unit
+                    if cells[location] == 0
+                ]
+                if not _unique_choice(unit_masks):
+                    return False
+
+        return True
+
 
-        # check the columns to make sure there is still a unique choice
-        # available for each empty location in the column
-        for column in range(9):
-            column_lists = [
-                self._possible_values[row][column]
-                for row in range(9)
-                if self._solution[row][column] == 0
-            ]
-            if not _unique_choice(column_lists):
+    def propagate(self, trace=None, strategies=()):
+        """
+        Enter numbers that are the only possible value for a location or that
+        have only one possible location in a region, row, or column until
+        nothing more is found.  Each number entered and the technique that
+        found it are recorded in trace if one is given.  Returns False if the
+        grid is found to have no solution.
+
+        When that stalls, the strategies named in strategies, see
+        STRATEGIES, are tried in the order given until one of them removes
+        some possible values, and entering numbers starts again.  The time
+        spent in each strategy and what it removed are recorded in trace.
+        """
+        if _STATS is not None:
+            return _STATS.propagate(self, trace, strategies)
+        return self._propagate(trace, strategies)
+
+
+    def _propagate(self, trace, strategies):
+        """ Do the work of propagate(). """
+        while True:
+            if not self._propagate_singles(trace):
                 return False
+            if not strategies or 0 not in self.cells:
+                return True
+            for name in strategies:
+                start = time.time()
+                removed = _STRATEGY_FUNCTIONS[name](self)
+                if trace is not None:
+                    trace.record_strategy(name, removed, time.time() - start)
+                if removed:
+                    break
+            else:
+                return True
+
+
+    def _propagate_singles(self, trace=None):
+        """ Enter numbers for propagate() until nothing more is found. """
+        cells = self.cells
+        candidates = self.candidates
+        geometry = self.geometry
+        all_values = geometry.all_values
+        mask_values = geometry.mask_values
+        locations = range(geometry.locations)
+        moves = None if trace is None else trace.moves
+        unit_groups = (
+            ("hidden single in region", geometry.region_locations,
+             self.region_masks),
+            ("hidden single in row", geometry.row_locations, self.row_masks),
+            ("hidden single in column", geometry.column_locations,
+             self.column_masks))
+        keep_going = True
+        while keep_going:
+            keep_going = False
+            if trace is not None:
+                trace.rounds += 1
+
+            # enter numbers in locations that have only one possible value
+            for location in locations:
+                mask = candidates[location]
+                if not mask & (mask - 1):
+                    if mask:
+                        # found a location with only one possible value
+                        keep_going = True
+                        value = mask.bit_length()
+                        self.place(location, value)
+                        if moves is not None:
+                            moves.append((location, value, "naked single"))
+                    elif not cells[location]:
+                        # an empty location with no possible values
+                        return False
+
+            # enter numbers that are possible values in a single location
+            # in a region, a row, or a column
+            for technique, units, unit_masks in unit_groups:
+                for i, unit in enumerate(units):
+                    # find the numbers that are possible values in exactly
+                    # one location in this unit
+                    once = 0
+                    twice = 0
+                    for location in unit:
+                        mask = candidates[location]
+                        twice |= once & mask
+                        once |= mask
+                    if once | unit_masks[i] != all_values:
+                        # a missing number has nowhere to go in this unit
+                        return False
+                    for value in mask_values[once & ~twice]:
+                        # found a number that can only go in one location
+                        bit = 1 << (value - 1)
+                        for location in unit:
+                            if candidates[location] & bit:
+                                keep_going = True
+                                self.place(location, value)
+                                if moves is not None:
+                                    moves.append((location, value, technique))
+                                break
 
         return True
 
 
+    def next_single(self):
+        """
+        Return the first (location, value, technique, unit) that
+        propagate() would enter, in the order it looks for them, or None.
+        unit is a ("region", "row" or "column", index) tuple for a hidden
+        single and None for a naked single.
+        """
+        candidates = self.candidates
+        geometry = self.geometry
+        for location in range(geometry.locations):
+            mask = candidates[location]
+            if mask and not mask & (mask - 1):
+                return location, mask.bit_length(), "naked single", None
+        for kind, units in (("region", geometry.region_locations),
+                            ("row", geometry.row_locations),
+                            ("column", geometry.column_locations)):
+            for index, unit in enumerate(units):
+                once = 0
+                twice = 0
+                for location in unit:
+                    mask = candidates[location]
+                    twice |= once & mask
+                    once |= mask
+                single = once & ~twice
+                if single:
+                    bit = single & -single
+                    for location in unit:
+                        if candidates[location] & bit:
+                            return (location, bit.bit_length(),
+                                    "hidden single in " + kind,
+                                    (kind, index))
+        return None
+
+
+    def remove(self, location):
+        """ Empty location and update the possible values of its peers. """
+        value = self.cells[location]
+        if not value:
+            return
+        geometry = self.geometry
+        if self.trail is not None:
+            self.trail.append(("remove", location, value, tuple(
+                self.candidates[peer] for peer in geometry.peers[location])))
+        keep = ~(1 << (value - 1))
+        self.cells[location] = 0
+        self.row_masks[geometry.row[location]] &= keep
+        self.column_masks[geometry.column[location]] &= keep
+        self.region_masks[geometry.region[location]] &= keep
+        self._refresh(location)
+        for peer in geometry.peers[location]:
+            self._refresh(peer)
+
+
+class SolveTrace(object):
+    """
+    A record of how a puzzle was solved: the numbers entered by propagation
+    and the techniques that found them, the number of propagation rounds,
+    and the guesses and dead ends of any search.  It is filled in as the
+    puzzle is solved without formatting any strings, so grading a puzzle
+    costs next to nothing beyond solving it.
+    """
+
+    def __init__(self):
+        """ Start an empty trace. """
+        # (location, value, technique) for each number entered by propagation
+        self.moves = []
+
+        # passes through the propagation loop
+        self.rounds = 0
+
+        # values tried by a search, and branches that led to no solution
+        self.guesses = 0
+        self.dead_ends = 0
+
+        # the values the "backtrack" search tries, up to _GRADED_GUESSES,
+        # which grade the puzzle whatever engine solved it
+        self.graded_guesses = 0
+
+        # the status of the solve, see solve_many()
+        self.status = None
+
+        # for each strategy in STRATEGIES that was tried: the times it
+        # removed possible values, the number of possible values it
+        # removed, and the seconds spent trying it
+        self.strategy_uses = {}
+        self.eliminations = {}
+        self.strategy_seconds = {}
+
+        # the Budget.stats() of the search if it had a budget
+        self.budget = None
+
+
+    def record_strategy(self, name, removed, seconds):
+        """
+        Record that trying strategy name took seconds and removed that many
+        possible values.
+        """
+        if removed:
+            self.strategy_uses[name] = self.strategy_uses.get(name, 0) + 1
+            self.eliminations[name] = self.eliminations.get(name, 0) + removed
+        self.strategy_seconds[name] = (
+            self.strategy_seconds.get(name, 0.0) + seconds)
+
+
+    def counts(self):
+        """ Return a dictionary of the number of moves for each technique. """
+        return dict(collections.Counter(move[2] for move in self.moves))
+
+
+    def score(self):
+        """
+        Return a difficulty score that weights each move by its technique
+        and adds weights for each time a strategy made progress, each
+        propagation round and each guess made by the "backtrack" search,
+        so the score is the same whichever engine solved the puzzle.
+        """
+        return (sum(_TECHNIQUE_WEIGHTS[move[2]] for move in self.moves) +
+                sum(_TECHNIQUE_WEIGHTS[name]*uses
+                    for name, uses in self.strategy_uses.items()) +
+                _ROUND_WEIGHT*self.rounds +
+                _GUESS_WEIGHT*self.graded_guesses)
+
+
+    def difficulty(self):
+        """
+        Return "easy", "medium", "hard" or "expert" for a solved puzzle, or
+        None if the puzzle was not solved.
+        """
+        if self.status != "solved":
+            return None
+        score = self.score()
+        for difficulty, limit in _DIFFICULTY_LIMITS:
+            if score <= limit:
+                return difficulty
+        return "expert"
+
+
+    def as_dict(self):
+        """ Return the trace summary as a dictionary, without the moves. """
+        return {
+            "status": self.status,
+            "counts": self.counts(),
+            "rounds": self.rounds,
+            "guesses": self.guesses,
+            "dead_ends": self.dead_ends,
+            "graded_guesses": self.graded_guesses,
+            "score": self.score(),
+            "difficulty": self.difficulty(),
+            "strategies": dict(
+                (name, {"uses": self.strategy_uses.get(name, 0),
+                        "eliminations": self.eliminations.get(name, 0),
+                        "seconds": seconds})
+                for name, seconds in self.strategy_seconds.items()),
+            "budget": self.budget,
+        }
+
+
+class Budget(object):
+    """
+    A limit on the work done by a search: a wall clock time in seconds from
+    when the budget is made and a number of search nodes, either of which
+    may be None for no limit.  A node is a value tried by a search, so the
+    limit bounds the work on a puzzle whatever the engine.  The searches
+    call spend() for every node and stop with BudgetExceeded once the
+    budget has run out.
+    """
+
+    __slots__ = ("started", "deadline", "max_nodes", "nodes", "reason")
+
+    def __init__(self, seconds=None, nodes=None):
+        """ Start a budget of seconds and nodes. """
+        self.started = time.time()
+        self.deadline = None if seconds is None else self.started + seconds
+        self.max_nodes = nodes
+        self.nodes = 0
+        self.reason = None
+
+
+    def spend(self, nodes=1):
+        """
+        Count nodes search nodes, or only check the clock for nodes=0, and
+        raise BudgetExceeded if the budget has run out.
+        """
+        self.nodes += nodes
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            self.reason = "nodes"
+        elif self.deadline is not None and time.time() > self.deadline:
+            self.reason = "time"
+        else:
+            return
+        raise BudgetExceeded(self.stats())
+
+
+    def stats(self):
+        """
+        Return a dictionary of the nodes searched, the seconds since the
+        budget was made, and "time" or "nodes" for the limit that ran out,
+        or None if neither has.
+        """
+        return {
+            "nodes": self.nodes,
+            "seconds": time.time() - self.started,
+            "exceeded": self.reason,
+        }
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised when a Budget runs out.  stats holds Budget.stats() along with
+    any progress made, such as the number of puzzles generated.
+    """
+
+    status = "budget exceeded"
+
+    def __init__(self, stats):
+        """ Make the exception for a budget with these stats. """
+        Exception.__init__(self, "%s (%s) after %d nodes in %.3f s" % (
+            self.status, stats["exceeded"], stats["nodes"],
+            stats["seconds"]))
+        self.stats = stats
+
+
+class SolverStats(object):
+    """
+    Counts of the work done by the solver and generator in this process,
+    collected while instrumentation is on: calls to the functions that
+    rebuild, look up and check possible values, propagation rounds, numbers
+    entered by each technique, guesses and dead ends of the searches, and
+    the seconds spent in each phase.  Phases can nest: the time of the
+    "search" phase includes the propagation done by the search.  The counts
+    can be exported as JSON or in the Prometheus text format.
+    """
+
+    def __init__(self):
+        """ Start with no work counted. """
+        self.calls = collections.Counter()
+        self.placements = collections.Counter()
+        self.rounds = 0
+        self.guesses = 0
+        self.dead_ends = 0
+        self.phase_seconds = collections.Counter()
+        self.phase_calls = collections.Counter()
+
+
+    def add_phase(self, phase, seconds):
+        """ Count a phase of work that took seconds. """
+        self.phase_seconds[phase] += seconds
+        self.phase_calls[phase] += 1
+
+
+    def propagate(self, state, trace, strategies):
+        """
+        Propagate a grid state for _GridState.propagate(), counting the
+        rounds, the numbers entered by each technique and the time taken.
+        """
+        if trace is None:
+            trace = SolveTrace()
+        moves = len(trace.moves)
+        rounds = trace.rounds
+        start = time.time()
+        result = state._propagate(trace, strategies)
+        self.add_phase("propagate", time.time() - start)
+        self.calls["_GridState.propagate"] += 1
+        self.rounds += trace.rounds - rounds
+        for _, _, technique in trace.moves[moves:]:
+            self.placements[technique] += 1
+        return result
+
+
+    def as_dict(self):
+        """ Return the counts as a dictionary. """
+        return {
+            "calls": dict(self.calls),
+            "placements": dict(self.placements),
+            "rounds": self.rounds,
+            "guesses": self.guesses,
+            "dead_ends": self.dead_ends,
+            "phases": dict(
+                (phase, {"calls": self.phase_calls[phase],
+                         "seconds": self.phase_seconds[phase]})
+                for phase in self.phase_calls),
+        }
+
+
+    def to_json(self):
+        """ Return the counts as a JSON string. """
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+
+    def to_prometheus(self, prefix="sudoku"):
+        """
+        Return the counts in the Prometheus text exposition format, as
+        counters named with prefix.
+        """
+        lines = []
+
+        def counter(name, description, label=None, values=None, value=0):
+            """ Add a counter with one value or a value for each label. """
+            name = "%s_%s_total" % (prefix, name)
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s counter" % name)
+            if label is None:
+                lines.append("%s %r" % (name, value))
+            else:
+                for key in sorted(values):
+                    lines.append('%s{%s="%s"} %r' % (
+                        name, label, key, values[key]))
+
+        counter("calls", "Calls to instrumented functions.", "function",
+                self.calls)
+        counter("placements", "Numbers entered by each technique.",
+                "technique", self.placements)
+        counter("propagation_rounds", "Passes through the propagation loop.",
+                value=self.rounds)
+        counter("guesses", "Values tried by the searches.",
+                value=self.guesses)
+        counter("dead_ends", "Search branches that led to no solution.",
+                value=self.dead_ends)
+        counter("phase_seconds", "Seconds spent in each phase.", "phase",
+                self.phase_seconds)
+        counter("phase_calls", "Times each phase was run.", "phase",
+                self.phase_calls)
+        return "\n".join(lines) + "\n"
+
+
+class SolutionCache(object):
+    """
+    A bounded least recently used cache of puzzle solutions keyed on the
+    canonical form of each puzzle, so a puzzle that was solved before is
+    found again after it was relabeled, rotated, transposed, or had its
+    bands and stacks permuted.  Solutions are mapped back to the puzzle that
+    was asked for.  The cache can be saved to and loaded from a file.
+    """
+
+    def __init__(self, capacity=10000, file_name=None):
+        """
+        Start a cache that holds up to capacity solutions, loading the
+        solutions saved in file_name if it is given and exists.
+        """
+        self.capacity = capacity
+
+        # lookups that found a solution and lookups that did not
+        self.hits = 0
+        self.misses = 0
+
+        # canonical puzzle line -> canonical solution line, the most
+        # recently used last
+        self._entries = collections.OrderedDict()
+
+        self.file_name = file_name
+        if file_name is not None and os.path.exists(file_name):
+            self.load(file_name)
+
+
+    def __len__(self):
+        """ Return the number of solutions in the cache. """
+        return len(self._entries)
+
+
+    def lookup(self, puzzle):
+        """
+        Return the cached solution of a puzzle given as accepted by
+        solve_many() as a list of numbers, or None if it is not cached.
+        """
+        canonical, transform = canonical_form(puzzle)
+        return self._lookup(_grid_line(canonical), transform)
+
+
+    def _lookup(self, key, transform):
+        """ Look up a canonical puzzle line and count the hit or miss. """
+        solution = self._entries.pop(key, None)
+        if solution is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = solution
+        return invert_transform(solution, transform)
+
+
+    def store(self, puzzle, solution):
+        """ Cache the solution of a puzzle, both as lists of numbers. """
+        canonical, transform = canonical_form(puzzle)
+        self._store(_grid_line(canonical),
+                    _grid_line(apply_transform(solution, transform)))
+
+
+    def _store(self, key, solution):
+        """
+        Cache the solution line of a canonical puzzle line, dropping the
+        least recently used solution when the cache is full.
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = solution
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+
+    def solve(self, puzzle, engine="dlx", index=0):
+        """
+        Return a SolveResult for a puzzle given as accepted by solve_many(),
+        using the cached solution if there is one and solving the puzzle
+        and caching its solution otherwise.  The trace of a cached result is
+        None.
+        """
+        try:
+            canonical, transform = canonical_form(puzzle)
+        except ValueError:
+            return SolveResult(index, "error", None, None)
+        key = _grid_line(canonical)
+        solution = self._lookup(key, transform)
+        if solution is not None:
+            return SolveResult(index, "solved", solution, None)
+        trace = SolveTrace()
+        status, state = _solve_state(_GridState(canonical), engine, trace)
+        if status == "solved":
+            self._store(key, _grid_line(state.cells))
+        return SolveResult(
+            index, status, invert_transform(state.cells, transform), trace)
+
+
+    def stats(self):
+        """ Return a dictionary of the cache size and hit and miss counts. """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / lookups if lookups else None,
+        }
+
+
+    def save(self, file_name=None):
+        """
+        Write the cached solutions to file_name, or to the file the cache
+        was loaded from, with a canonical puzzle and its solution in the
+        one line format on each line from least to most recently used.
+        """
+        if file_name is None and self.file_name is None:
+            raise ValueError("no file to save the cache to")
+        _write_buffered(
+            (key + " " + solution + "\n"
+             for key, solution in self._entries.items()),
+            file_name or self.file_name)
+
+
+    def load(self, file_name):
+        """ Add the solutions saved in file_name by save() to the cache. """
+        with open(file_name) as file_handle:
+            for line in file_handle:
+                fields = line.split()
+                if len(fields) == 2:
+                    self._store(fields[0], fields[1])
+
+
+class PackedGrids(object):
+    """
+    Read only access to a file in the packed binary format written by
+    write_packed().  The records are memory mapped, so opening a file of
+    any size is immediate and only the grids that are used are read.
+    """
+
+    def __init__(self, file_name):
+        """ Open a packed file.  Raises ValueError if it is not one. """
+        with open(file_name, "rb") as file_handle:
+            header = file_handle.read(_PACKED_HEADER.size)
+        if len(header) < _PACKED_HEADER.size:
+            raise ValueError(file_name + " is not a packed Sudoku file")
+        magic, version, box_size, bits, count = _PACKED_HEADER.unpack(header)
+        if magic != _PACKED_MAGIC or version != _PACKED_VERSION:
+            raise ValueError(file_name + " is not a packed Sudoku file")
+
+        self.file_name = file_name
+        self.box_size = box_size
+        self.bits = bits
+        self.locations = _geometry(box_size).locations
+        self.record_size = _packed_record_size(self.locations, bits)
+
+        # the number of grids in the file
+        self.count = count
+        if count:
+            self.records = numpy.memmap(
+                file_name, numpy.uint8, "r", _PACKED_HEADER.size,
+                (count, self.record_size))
+        else:
+            self.records = numpy.zeros((0, self.record_size), numpy.uint8)
+
+
+    def __len__(self):
+        """ Return the number of grids in the file. """
+        return self.count
+
+
+    def __getitem__(self, index):
+        """ Return grid number index as a list of numbers. """
+        if index < 0:
+            index += self.count
+        return self.grids(index, index + 1)[0].tolist()
+
+
+    def grids(self, start=0, stop=None):
+        """
+        Return the grids from start up to stop as an (N, locations) uint8
+        array, ready for solve_array() or validate_many().  For 8 bit files
+        this is a view of the memory mapped file and nothing is copied.
+        """
+        records = self.records[start:stop]
+        if self.bits == 8:
+            return records
+        return _unpack_nibbles(records, self.locations)
+
+
+    def chunks(self, chunk_size=65536):
+        """
+        Generate the grids in the file as (N, locations) arrays of at most
+        chunk_size grids.
+        """
+        for start in range(0, self.count, chunk_size):
+            yield self.grids(start, start + chunk_size)
+
+
 ################################################################################
 # Function definitions
 ################################################################################
 
-def _region_row_range(region_number):
+def start_instrumentation():
+    """
+    Start counting the work done by the solver and generator in this
+    process and return the SolverStats the counts are added to.  Work done
+    by the worker processes of solve_many() is not counted.
+    """
+    global _STATS
+    _STATS = SolverStats()
+    return _STATS
+
+
+def stop_instrumentation():
+    """ Stop counting and return the SolverStats collected, or None. """
+    global _STATS
+    stats = _STATS
+    _STATS = None
+    return stats
+
+
+def _geometry(box_size):
     """
-    Returns a list of the rows that intersect the region specified by
-    the integer region_number.  The regions are numbered 0-8 from top left
-    to bottom right.
+    Return the _Geometry for grids made of box_size by box_size regions,
+    building its tables the first time they are needed.
     """
-    starting_row = 3*(region_number/3)
-    return range(starting_row, starting_row + 3)
+    geometry = _GEOMETRIES.get(box_size)
+    if geometry is None:
+        if box_size not in _BOX_SIZES.values():
+            raise ValueError("unsupported box size " + repr(box_size))
+        geometry = _GEOMETRIES[box_size] = _Geometry(box_size)
+    return geometry
 
 
-def _region_column_range(region_number):
+def _geometry_for(cells):
     """
-    Returns a list of the columns that intersect the region specified by
-    the integer region_number.  The regions are numbered 0-8 from top left
-    to bottom right.
+    Return the _Geometry for a grid given as a list of numbers, or for a 9
+    by 9 grid if cells is None.  Raises ValueError if the number of cells
+    is not the size of a supported grid.
     """
-    starting_column = 3*(region_number % 3)
-    return range(starting_column, starting_column + 3)
+    if cells is None:
+        return _geometry(3)
+    if len(cells) not in _GRID_BOX_SIZES:
+        raise ValueError(
+            "a grid cannot have " + str(len(cells)) + " locations")
+    return _geometry(_GRID_BOX_SIZES[len(cells)])
 
 
 def _grid_to_csv_string(grid_data):
     """
-    Make a string of comma separated values from a 9 by 9 grid of numbers
+    Make a string of comma separated values from a square grid of numbers
     """
-    assert grid_data.size == 81
-    csv_string = ""
-    for row in grid_data:
-        for entry in row:
-            csv_string += str(entry) + ","
-        # remove comma after the last entry in each row
-        csv_string = csv_string[0:-1] + "\n"
-    return csv_string
+    assert grid_data.size in _GRID_BOX_SIZES
+    return _cells_to_csv_string(grid_data.flatten().tolist())
+
+
+def _cells_to_csv_string(cells):
+    """
+    Make a string of comma separated values with one line for each row from
+    a list of numbers
+    """
+    size = _geometry_for(cells).size
+    entries = list(str(value) for value in cells)
+    return "".join(",".join(entries[i:i + size]) + "\n"
+                   for i in range(0, len(entries), size))
 
 
 def _print_grid(grid_data):
-    """ Print a 9 by 9 grid of numbers """
-    print _grid_to_csv_string(grid_data)
+    """ Print a square grid of numbers """
+    print(_grid_to_csv_string(grid_data))
 
 
 def _grid_to_csv(grid_data, file_name):
     """
-    Write a 9 by 9 grid of numbers
+    Write a square grid of numbers
     to a file of comma separated values
     """
     try:
@@ -499,82 +1728,1750 @@ def _grid_to_csv(grid_data, file_name):
         exit("There was a problem writing to " + file_name)
 
 
-def _constraining_locations(row, column):
-    """
-    Return a 9 by 9 array that has ones in the row, column, and 3 by 3 region
-    surrounding the location specified by row and column.
-    """
-    constraining_locations = numpy.zeros([9, 9], numpy.int)
-    # add locations in the row to the constraining locations
-    for i in range(9):
-        constraining_locations[row, i] = 1
-    # add locations in the column to the constraining locations
-    for i in range(9):
-        constraining_locations[i, column] = 1
-    # add locations in the region to the constraining locations
-    for i in numpy.array(range(3)) + 3*(row/3):
-        for j in numpy.array(range(3)) + 3*(column/3):
-            constraining_locations[i, j] = 1
-    # remove the location itself from the constraining locations
-    constraining_locations[row, column] = 0
-    return constraining_locations
-
-
-def _unique_choice(list_of_lists):
-    """
-    Determine if unique values can be chosen from a group of sets. In general
-    this is a rather challenging / computationally intensive problem, but for
-    generating Sudoku puzzles we only start to run into problems when the
-    choices are narrowed down to one or two.
-    """
-    sizes = [len(set(l)) for l in list_of_lists]
-
-    # if any set has 0 members return false
-    if 0 in sizes:
-        return False
-
-    # if the union of sets containing a single number has fewer members than
-    # the number of these sets then at least two of these sets contain the same
-    # number and unique values cannot be chosen from each set
-    sets_in_union = 0
-    union_of_sets = set([])
-    for i, size in enumerate(sizes):
-        if size == 1:
-            sets_in_union = sets_in_union + 1
-            union_of_sets = union_of_sets.union(set(list_of_lists[i]))
-            if len(union_of_sets) < sets_in_union:
-                return False
+def read_puzzles(source, file_format=None):
+    """
+    Generate a PuzzleRecord for each puzzle in a file, reading one line at a
+    time so files of any size can be read.  source is a file name, an open
+    file, or any other iterable of lines.  file_format is "line" for one
+    puzzle per line with a character for each location, "0" or "." for empty
+    locations, and the letters A-P for the numbers 10-25, "csv" for blocks
+    of comma separated values with a line for each row, or None to tell
+    from the first line.  The size of each puzzle is taken from the number
+    of characters in its line or the number of values in the first row of
+    its block, so 9 by 9 puzzles have lines of 81 characters or blocks of 9
+    lines of 9 values.  In the "line" format anything after the characters
+    and a space is ignored.  In the "csv" format blocks may be separated by
+    blank lines, and a line without a comma right after a block is ignored.
+
+    Records that cannot be read have cells set to None and an error message,
+    and reading continues with the next record.
+    """
+    if isinstance(source, str):
+        file_handle = open(source)
+    else:
+        file_handle = source
+    try:
+        lines = file_handle
+        if file_format is None:
+            file_format, lines = _detect_format(lines)
+        if file_format == "line":
+            records = _read_lines(enumerate(lines, 1))
+        elif file_format == "csv":
+            records = _read_csv_blocks(enumerate(lines, 1))
+        else:
+            raise ValueError("unknown file format " + repr(file_format))
+        for record in records:
+            yield record
+    finally:
+        if file_handle is not source:
+            file_handle.close()
+
+
+def _detect_format(lines):
+    """
+    Return "csv" if the first line that is not blank contains a comma and
+    "line" otherwise, along with an iterator over all of the lines.
+    """
+    lines = iter(lines)
+    seen = []
+    for line in lines:
+        seen.append(line)
+        if line.strip():
+            break
+    file_format = "csv" if seen and "," in seen[-1] else "line"
+    return file_format, itertools.chain(seen, lines)
+
+
+def _read_lines(lines):
+    """ Generate PuzzleRecords from numbered lines with one puzzle each. """
+    index = 0
+    for number, line in lines:
+        text = line.strip()
+        if not text:
+            continue
+        try:
+            cells = _line_cells(text.split(None, 1)[0])
+        except ValueError as error:
+            yield PuzzleRecord(index, number, None, str(error))
+        else:
+            yield PuzzleRecord(index, number, cells, None)
+        index += 1
+
+
+def _read_csv_blocks(lines):
+    """
+    Generate PuzzleRecords from numbered lines that form blocks of comma
+    separated values, with as many lines in a block as there are values in
+    its first line.  A blank line ends a short block, and a line without a
+    comma right after a block, such as the status written by the solve
+    command, is skipped.
+    """
+    index = 0
+    rows = []
+    first_number = None
+    expected = 0
+    after_block = False
+    for number, line in itertools.chain(lines, [(None, "")]):
+        text = line.strip()
+        if after_block and text and "," not in text:
+            after_block = False
+            continue
+        after_block = False
+        if text:
+            if not rows:
+                first_number = number
+                expected = text.count(",") + 1
+            rows.append(text)
+            if len(rows) < expected:
+                continue
+        elif not rows:
+            continue
+        try:
+            cells = _csv_rows_cells(rows)
+        except ValueError as error:
+            yield PuzzleRecord(index, first_number, None, str(error))
+        else:
+            yield PuzzleRecord(index, first_number, cells, None)
+        index += 1
+        rows = []
+        after_block = bool(text)
+
+
+def _line_cells(text):
+    """
+    Return a list of numbers from a string with a character for each
+    location, "0" or "." for empty locations and the letters A-P for the
+    numbers 10-25.  Raises ValueError if it cannot be read.
+    """
+    if len(text) not in _GRID_BOX_SIZES:
+        raise ValueError("expected 16, 81, 256 or 625 characters, found " +
+                         str(len(text)))
+    size = _geometry(_GRID_BOX_SIZES[len(text)]).size
+    if len(text) == 81:
+        # str.isdigit() also accepts digits such as "\u00b2" outside ASCII
+        digits = text.replace(".", "0")
+        if not (digits.isascii() and digits.isdigit()):
+            raise ValueError("unexpected character in " + repr(text))
+        cells = list(ord(digit) - 48 for digit in digits)
+    else:
+        try:
+            cells = list(_SYMBOL_VALUES[symbol] for symbol in text)
+        except KeyError:
+            raise ValueError("unexpected character in " + repr(text))
+    if max(cells) > size:
+        raise ValueError("unexpected character in " + repr(text))
+    return cells
+
+
+def _csv_rows_cells(rows):
+    """
+    Return a list of numbers from strings of comma separated values, one
+    for each row.  Raises ValueError if they cannot be read.
+    """
+    size = len(rows[0].split(","))
+    if size not in _BOX_SIZES:
+        raise ValueError("a grid cannot have " + str(size) + " columns")
+    if len(rows) != size:
+        raise ValueError(
+            "expected " + str(size) + " rows, found " + str(len(rows)))
+    cells = []
+    for row in rows:
+        entries = row.split(",")
+        if len(entries) != size:
+            raise ValueError("expected " + str(size) + " columns, found " +
+                             str(len(entries)))
+        cells.extend(int(entry) for entry in entries)
+    for value in cells:
+        if value < 0 or value > size:
+            raise ValueError("entries must be 0-" + str(size) + ", found " +
+                             str(value))
+    return cells
+
+
+def write_puzzles(grids, destination, file_format="line", buffer_size=1024):
+    """
+    Write grids given as sequences of numbers to a file in the "line" or
+    "csv" format of read_puzzles(), with a blank line after each csv block.
+    destination is a file name or an open file.  Grids are formatted in
+    batches of buffer_size and each batch is written with a single call.
+    Returns the number of grids written.
+    """
+    if file_format == "line":
+        lines = (_grid_line(cells) + "\n" for cells in grids)
+    elif file_format == "csv":
+        lines = (_cells_to_csv_string(cells) + "\n" for cells in grids)
+    else:
+        raise ValueError("unknown file format " + repr(file_format))
+    return _write_buffered(lines, destination, buffer_size)
+
+
+def _write_buffered(lines, destination, buffer_size=1024):
+    """
+    Write an iterable of strings to a file name or open file, buffer_size
+    strings at a time.  Returns the number of strings written.
+    """
+    if isinstance(destination, str):
+        file_handle = open(destination, "w")
+    else:
+        file_handle = destination
+    count = 0
+    try:
+        while True:
+            batch = list(itertools.islice(lines, buffer_size))
+            if not batch:
+                break
+            file_handle.write("".join(batch))
+            count += len(batch)
+    finally:
+        if file_handle is not destination:
+            file_handle.close()
+    return count
+
+
+def write_packed(grids, file_name, box_size=None, bits=None,
+                 chunk_size=65536):
+    """
+    Write grids, given as sequences of numbers or as an (N, locations)
+    array, to a file in the packed binary format read by PackedGrids.
+    box_size is taken from the first grid if it is not given.  bits is 4 or
+    8 for each location and defaults to 4 when the numbers fit, which takes
+    41 bytes for a 9 by 9 grid.  Use bits=8 for 81 byte records that can be
+    memory mapped without unpacking.  Grids are packed chunk_size at a time.
+    Returns the number of grids written.
+    """
+    grids = iter(grids)
+    first = list(itertools.islice(grids, 1))
+    if box_size is None:
+        box_size = (_geometry_for(list(first[0])).box_size if first
+                    else 3)
+    geometry = _geometry(box_size)
+    if bits is None:
+        bits = 4 if geometry.size < 16 else 8
+    if bits not in (4, 8) or (1 << bits) <= geometry.size:
+        raise ValueError("cannot pack " + str(geometry.size) + " numbers in "
+                         + str(bits) + " bits")
+    grids = itertools.chain(first, grids)
+
+    count = 0
+    with open(file_name, "wb") as file_handle:
+        file_handle.write(_PACKED_HEADER.pack(
+            _PACKED_MAGIC, _PACKED_VERSION, box_size, bits, 0))
+        while True:
+            chunk = list(itertools.islice(grids, chunk_size))
+            if not chunk:
+                break
+            cells = numpy.array(chunk, numpy.uint8).reshape(
+                len(chunk), geometry.locations)
+            if cells.max() > geometry.size:
+                raise ValueError("entries must be 0-" + str(geometry.size))
+            if bits == 4:
+                cells = _pack_nibbles(cells)
+            cells.tofile(file_handle)
+            count += len(chunk)
+        # now that the number of grids is known, fill it in
+        file_handle.seek(0)
+        file_handle.write(_PACKED_HEADER.pack(
+            _PACKED_MAGIC, _PACKED_VERSION, box_size, bits, count))
+    return count
+
+
+def pack_puzzles(source, file_name, file_format=None, bits=None):
+    """
+    Convert a file in the "line" or "csv" format of read_puzzles() to the
+    packed binary format, skipping records that cannot be read.  Returns the
+    number of grids written.
+    """
+    records = read_puzzles(source, file_format)
+    return write_packed(
+        (record.cells for record in records if record.cells is not None),
+        file_name, bits=bits)
+
+
+def unpack_puzzles(file_name, destination, file_format="line"):
+    """
+    Convert a file in the packed binary format to the "line" or "csv"
+    format of read_puzzles().  Returns the number of grids written.
+    """
+    packed = PackedGrids(file_name)
+    grids = (cells for chunk in packed.chunks()
+             for cells in chunk.tolist())
+    return write_puzzles(grids, destination, file_format)
+
+
+def _packed_record_size(locations, bits):
+    """ Return the number of bytes in the record for a grid. """
+    return (locations*bits + 7) // 8
+
+
+def _pack_nibbles(cells):
+    """
+    Pack an (N, locations) uint8 array of numbers below 16 two to a byte,
+    high bits first, padding an odd number of locations with a zero.
+    """
+    if cells.shape[1] % 2:
+        cells = numpy.hstack(
+            (cells, numpy.zeros((len(cells), 1), numpy.uint8)))
+    return (cells[:, 0::2] << 4) | cells[:, 1::2]
+
+
+def _unpack_nibbles(records, locations):
+    """ Undo _pack_nibbles() for (N, record_size) uint8 records. """
+    cells = numpy.empty((len(records), 2*records.shape[1]), numpy.uint8)
+    cells[:, 0::2] = records >> 4
+    cells[:, 1::2] = records & 0x0f
+    return cells[:, :locations]
+
+
+def validate(grid, complete=True):
+    """
+    Check a grid given as a string or a sequence of numbers, as accepted by
+    solve_many(), and return a list of the units
+    that break the rules as ("row", i), ("column", i) or ("region", i)
+    tuples with i numbered from 0.  A unit is invalid if a number appears in
+    it twice or, when complete is true, if it has an empty location, so an
+    empty list means the grid is a valid solution, or a consistent partial
+    grid when complete is false.  Raises ValueError if the grid cannot be
+    read.
+    """
+    cells = _grid_cells(grid)
+    geometry = _geometry_for(cells)
+    size = geometry.size
+    mask_size = geometry.mask_size
+    invalid = []
+    for unit_name, units in (("row", geometry.row_locations),
+                             ("column", geometry.column_locations),
+                             ("region", geometry.region_locations)):
+        for i, unit in enumerate(units):
+            used = 0
+            filled = 0
+            for location in unit:
+                value = cells[location]
+                if value:
+                    used |= 1 << (value - 1)
+                    filled += 1
+            if mask_size[used] != filled or (complete and filled != size):
+                invalid.append((unit_name, i))
+    return invalid
+
+
+def validate_many(grids, complete=True):
+    """
+    Check a batch of grids given as an integer array of shape (N, 9, 9) or
+    (N, 81), or (N, size, size) or (N, size*size) for other sizes, with
+    whole array operations.  Returns a tuple (valid, invalid) where valid is
+    a boolean array marking the grids that pass validate() and invalid is a
+    (N, 3, size) boolean array marking the rows, columns and regions of each
+    grid that do not.  Raises ValueError if any entries are out of range.
+    """
+    grids = numpy.asarray(grids)
+    geometry = _array_geometry(grids)
+    box_size = geometry.box_size
+    size = geometry.size
+    count = grids.shape[0]
+    grid = grids.reshape(count, size, size)
+    if count and (grid.min() < 0 or grid.max() > size):
+        raise ValueError("entries must be 0-" + str(size))
+    tables = _array_tables(box_size)
+    mask_size = tables["mask_size"]
+    bits = tables["value_bit"][grid]
+    filled = grid > 0
+    blocks = (count, box_size, box_size, box_size, box_size)
+
+    used = numpy.empty((count, 3, size), tables["dtype"])
+    used[:, 0] = numpy.bitwise_or.reduce(bits, axis=2)
+    used[:, 1] = numpy.bitwise_or.reduce(bits, axis=1)
+    used[:, 2] = numpy.bitwise_or.reduce(numpy.bitwise_or.reduce(
+        bits.reshape(blocks), axis=4), axis=2).reshape(count, size)
+    filled_count = numpy.empty((count, 3, size), numpy.intp)
+    filled_count[:, 0] = filled.sum(axis=2)
+    filled_count[:, 1] = filled.sum(axis=1)
+    filled_count[:, 2] = filled.reshape(blocks).sum(
+        axis=(2, 4)).reshape(count, size)
+
+    invalid = mask_size(used) != filled_count
+    if complete:
+        invalid |= filled_count != size
+    return ~invalid.any(axis=(1, 2)), invalid
+
+
+def solve_many(puzzles, workers=None, chunksize=64, engine="dlx",
+               ordered=True, strategies=(), seconds=None, nodes=None):
+    """
+    Solve many puzzles using a pool of worker processes.  Each puzzle is a
+    string in the "line" format of read_puzzles(), such as 81 characters
+    with "0" or "." for empty locations, or a sequence of numbers given flat
+    or as rows, such as 9 rows of 9, with zeros for empty locations.
+    Generates a SolveResult for each puzzle, in the order the puzzles were
+    given if ordered is true or as they are finished otherwise.
+
+    The status of each result is "solved", "unsolvable" if the puzzle has no
+    solution, "invalid" if it fails the checks in _puzzle_solvable(),
+    "unfinished" if the "propagate" engine could not finish it, or "error" if
+    it could not be read.  The solution is a list of numbers with zeros in
+    any locations that were not filled, and the trace is a SolveTrace that
+    describes how the puzzle was solved.  Both are None for an "error".
+
+    workers defaults to the number of CPUs, and workers=1 solves the puzzles
+    in this process, as is done when there are fewer than chunksize
+    puzzles since starting the workers would take longer than solving them.
+    Puzzles are sent to the workers in chunks of chunksize.
+    strategies are the extra techniques used, as for Sudoku.solve(), and
+    seconds and nodes are the budget of each puzzle.  A puzzle that runs
+    out of budget has the status "budget exceeded", the solution as far as
+    propagation got, and the budget stats in its trace.
+    """
+    if engine not in _ENGINES:
+        raise ValueError("unknown engine " + repr(engine))
+    strategies = _strategy_names(strategies)
+    jobs = ((index, puzzle, engine, strategies, seconds, nodes)
+            for index, puzzle in enumerate(puzzles))
+    first = list(itertools.islice(jobs, chunksize))
+    jobs = itertools.chain(first, jobs)
+
+    if workers == 1 or len(first) < chunksize:
+        for job in jobs:
+            yield _solve_job(job)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        if ordered:
+            results = pool.imap(_solve_job, jobs, chunksize)
+        else:
+            results = pool.imap_unordered(_solve_job, jobs, chunksize)
+        for result in results:
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _solve_job(job):
+    """
+    Solve one (index, puzzle, engine, strategies, seconds, nodes) job for
+    solve_many().
+    """
+    index, puzzle, engine, strategies, seconds, nodes = job
+    try:
+        cells = _grid_cells(puzzle)
+    except ValueError:
+        return SolveResult(index, "error", None, None)
+    trace = SolveTrace()
+    status, state = _solve_state(_GridState(cells), engine, trace,
+                                 strategies, _budget(seconds, nodes))
+    return SolveResult(index, status, state.cells.tolist(), trace)
+
+
+def _solve_state(state, engine="propagate", trace=None, strategies=(),
+                 budget=None):
+    """
+    Solve a grid state with one of the engines in _ENGINES and the strategies
+    named, recording how it was solved in trace if one is given.  Returns a
+    (status, state) tuple where status is "solved", "unsolvable", "invalid"
+    or "unfinished" as described in solve_many(), or "budget exceeded" if
+    the search ran out of budget.  The state given may be modified.
+    """
+    status, state = _run_engine(state, engine, trace, strategies, budget)
+    if trace is not None:
+        trace.status = status
+        if budget is not None:
+            trace.budget = budget.stats()
+    return status, state
+
+
+def _run_engine(state, engine, trace, strategies, budget):
+    """ Do the work of _solve_state(). """
+    if not state.solvable():
+        return "invalid", state
+    if not state.propagate(trace, strategies):
+        return "unsolvable", state
+    if 0 not in state.cells:
+        return "solved", state
+    search = _ENGINES[engine]
+    if search is None:
+        return "unfinished", state
+    start = time.time()
+    try:
+        cells = next(search(state.copy(), trace, strategies, budget), None)
+    except BudgetExceeded:
+        return "budget exceeded", state
+    finally:
+        if _STATS is not None:
+            _STATS.add_phase("search", time.time() - start)
+    if cells is None:
+        return "unsolvable", state
+    if trace is not None:
+        trace.graded_guesses = _graded_guesses(state, engine, trace,
+                                               strategies)
+    return "solved", _GridState(cells, state.geometry)
+
+
+def _graded_guesses(state, engine, trace, strategies):
+    """
+    Return the values the "backtrack" search tries, up to _GRADED_GUESSES,
+    to solve a grid state that propagation could not finish.  The other
+    engines search in a different order, so the puzzle is searched again
+    for them, stopping once the count is enough for the hardest grade.
+    """
+    if engine == "backtrack":
+        return min(trace.guesses, _GRADED_GUESSES)
+    counter = SolveTrace()
+    try:
+        next(_backtrack(state.copy(), counter, strategies,
+                        Budget(nodes=_GRADED_GUESSES)), None)
+    except BudgetExceeded:
+        pass
+    return min(counter.guesses, _GRADED_GUESSES)
+
+
+def _grid_cells(grid):
+    """
+    Return a list of numbers for a grid given as a string in the "line"
+    format of read_puzzles(), or as a sequence of numbers given flat or as
+    rows.  Raises ValueError if the grid cannot be read.
+    """
+    if grid is None:
+        raise ValueError("no grid")
+    if isinstance(grid, str):
+        return _line_cells(grid.strip())
+    else:
+        cells = []
+        for entry in grid:
+            if hasattr(entry, "__len__"):
+                cells.extend(int(i) for i in entry)
+            else:
+                cells.append(int(entry))
+    size = _geometry_for(cells).size
+    for value in cells:
+        if value < 0 or value > size:
+            raise ValueError("entries must be 0-" + str(size) + ", found " +
+                             str(value))
+    return cells
+
+
+def _grid_line(cells):
+    """
+    Make a string with a character for each number in a list of numbers,
+    with "." for empty locations and the letters A-P for the numbers 10-25.
+    """
+    return "".join(_SYMBOLS[value] for value in cells)
 
-    # if the union of sets with 1 or 2 members has fewer members than
-    # the number of these sets then there is no solution
-    for i, size in enumerate(sizes):
-        if size == 2:
-            sets_in_union = sets_in_union + 1
-            union_of_sets = union_of_sets.union(set(list_of_lists[i]))
-            if len(union_of_sets) < sets_in_union:
-                return False
 
+def solve_array(grids, engine="propagate", chunk_size=65536):
+    """
+    Solve a batch of puzzles given as an integer array of shape (N, 9, 9) or
+    (N, 81), or (N, size, size) or (N, size*size) for other sizes, with
+    zeros for empty locations.  The rules used by solve() are
+    applied to all of the puzzles at once with whole array operations, so
+    easy puzzles are solved far faster than one Sudoku at a time.  Puzzles
+    are processed chunk_size at a time to limit memory use.
+
+    Returns a tuple (solutions, unfinished, unsolvable) where solutions has
+    the shape and type of grids, unfinished is a boolean array marking the
+    puzzles that still have empty locations and need a search, and
+    unsolvable marks the puzzles that were shown to have no solution.  With
+    engine="backtrack" or engine="dlx" the unfinished puzzles are then
+    solved one at a time by that engine.
+    """
+    if engine not in _ENGINES:
+        raise ValueError("unknown engine " + repr(engine))
+    grids = numpy.asarray(grids)
+    geometry = _array_geometry(grids)
+    count = grids.shape[0]
+    cells = grids.reshape(count, geometry.locations)
+    if count and (cells.min() < 0 or cells.max() > geometry.size):
+        raise ValueError("entries must be 0-" + str(geometry.size))
+
+    solutions = numpy.empty((count, geometry.locations), grids.dtype)
+    unfinished = numpy.zeros(count, bool)
+    unsolvable = numpy.zeros(count, bool)
+    for start in range(0, count, chunk_size):
+        stop = min(start + chunk_size, count)
+        chunk, failed = _propagate_array(cells[start:stop], geometry)
+        solutions[start:stop] = chunk
+        unsolvable[start:stop] = failed
+        unfinished[start:stop] = ~failed & (chunk == 0).any(axis=1)
+
+    if _ENGINES[engine] is not None:
+        for index in numpy.flatnonzero(unfinished):
+            status, state = _solve_state(
+                _GridState(solutions[index].tolist(), geometry), engine)
+            solutions[index] = state.cells
+            unfinished[index] = False
+            unsolvable[index] = status != "solved"
+
+    return solutions.reshape(grids.shape), unfinished, unsolvable
+
+
+def _propagate_array(cells, geometry):
+    """
+    Enter numbers that are the only possible value for a location or that
+    have only one possible location in a region, row, or column in each of
+    the (N, locations) puzzles in cells until nothing more is found.
+    Returns the resulting uint8 array and a boolean array marking the
+    puzzles that were found to have no solution.
+    """
+    box_size = geometry.box_size
+    size = geometry.size
+    blocks = (box_size, box_size, box_size, box_size)
+    tables = _array_tables(box_size)
+    value_bit = tables["value_bit"]
+    mask_size = tables["mask_size"]
+    mask_value = tables["mask_value"]
+
+    cells = numpy.array(cells, numpy.uint8)
+    failed = numpy.zeros(len(cells), bool)
+    # puzzles that changed in the last pass and so need another pass
+    active = numpy.arange(len(cells))
+    while len(active):
+        count = len(active)
+        grid = cells[active].reshape(count, size, size)
+        filled = grid > 0
+        bits = value_bit[grid]
+
+        # the numbers entered in each row, column, and region, with the
+        # regions spread back out over the grid
+        row_used = numpy.bitwise_or.reduce(bits, axis=2)
+        column_used = numpy.bitwise_or.reduce(bits, axis=1)
+        region_used = numpy.bitwise_or.reduce(numpy.bitwise_or.reduce(
+            bits.reshape((count,) + blocks), axis=4), axis=2)
+        region_grid = _spread_regions(region_used)
+
+        # the possible values of each location
+        candidates = geometry.all_values & ~(
+            row_used[:, :, None] | column_used[:, None, :] | region_grid)
+        candidates[filled] = 0
+
+        # a number entered twice in a unit means there is no solution
+        broken = (
+            (mask_size(row_used) != filled.sum(axis=2)).any(axis=1) |
+            (mask_size(column_used) != filled.sum(axis=1)).any(axis=1) |
+            (mask_size(region_used) != filled.reshape(
+                (count,) + blocks).sum(axis=(2, 4))).any(axis=(1, 2)))
+        # so does an empty location with no possible values
+        broken |= ((candidates == 0) & ~filled).any(axis=(1, 2))
+
+        # the numbers with exactly one possible location in each row,
+        # column, and region
+        regions = candidates.reshape((count,) + blocks).transpose(
+            0, 1, 3, 2, 4).reshape(count, size, size)
+        all_values = geometry.all_values
+        only_row = _only_once(candidates, row_used, all_values)
+        only_column = _only_once(
+            candidates.transpose(0, 2, 1), column_used, all_values)
+        only_region = _only_once(
+            regions, region_used.reshape(count, size), all_values)
+        # a number missing from a unit with nowhere to go means there is no
+        # solution
+        broken |= (only_row[1] | only_column[1] | only_region[1])
+        hidden = candidates & (
+            only_row[0][:, :, None] | only_column[0][:, None, :] |
+            _spread_regions(
+                only_region[0].reshape(count, box_size, box_size)))
+
+        # enter the only possible value of each location and the numbers
+        # that only have one possible location in a unit
+        new_bits = numpy.where(mask_size(candidates) == 1, candidates, 0)
+        new_bits |= hidden
+        broken |= (mask_size(new_bits) > 1).any(axis=(1, 2))
+        new_values = mask_value(new_bits)
+
+        grid = numpy.where(new_values > 0, new_values, grid)
+        cells[active] = grid.reshape(count, geometry.locations)
+        failed[active[broken]] = True
+        changed = (new_values > 0).any(axis=(1, 2)) & ~broken
+        active = active[changed]
+
+    return cells, failed
+
+
+def _spread_regions(region_masks):
+    """
+    Return a (N, size, size) array with each entry of a (N, box_size,
+    box_size) array of region masks copied to the locations of its region.
+    """
+    count, box_size = region_masks.shape[:2]
+    size = box_size*box_size
+    return numpy.broadcast_to(
+        region_masks[:, :, None, :, None],
+        (count, box_size, box_size, box_size, box_size)).reshape(
+            count, size, size)
+
+
+def _only_once(unit_candidates, used, all_values):
+    """
+    Given a (N, size, size) array with the possible values of the locations
+    of each unit and the (N, size) numbers already entered in them, return a
+    (N, size) array of the numbers with exactly one possible location in
+    each unit and a (N,) boolean array marking grids where some number
+    missing from a unit has no possible location.
+    """
+    once = numpy.zeros(used.shape, used.dtype)
+    twice = numpy.zeros(used.shape, used.dtype)
+    for i in range(used.shape[1]):
+        twice |= once & unit_candidates[:, :, i]
+        once |= unit_candidates[:, :, i]
+    return once & ~twice, ((once | used) != all_values).any(axis=1)
+
+
+def _array_geometry(grids):
+    """
+    Return the _Geometry for a batch of grids given as an array of shape
+    (N, size, size) or (N, size*size).  Raises ValueError for other shapes.
+    """
+    if grids.ndim == 3 and grids.shape[1] == grids.shape[2]:
+        locations = grids.shape[1]*grids.shape[2]
+    elif grids.ndim == 2:
+        locations = grids.shape[1]
+    else:
+        locations = None
+    if locations not in _GRID_BOX_SIZES:
+        raise ValueError("grids cannot have shape " + str(grids.shape))
+    return _geometry(_GRID_BOX_SIZES[locations])
+
+
+_ARRAY_TABLES = {}
+
+
+def _array_tables(box_size):
+    """
+    Return a dictionary of the lookup tables used by _propagate_array() for
+    grids with the given box size, building them the first time they are
+    needed.  "mask_size" and "mask_value" are functions of an array of
+    masks, which use tables when the masks are narrow enough.
+    """
+    tables = _ARRAY_TABLES.get(box_size)
+    if tables is None:
+        size = box_size*box_size
+        tables = _ARRAY_TABLES[box_size] = {}
+        tables["dtype"] = numpy.uint16 if size <= 16 else numpy.uint32
+        tables["value_bit"] = numpy.array(
+            [0] + list(1 << i for i in range(size)), tables["dtype"])
+        if size <= 16:
+            masks = numpy.arange(1 << size)
+            mask_size = numpy.zeros(1 << size, numpy.intp)
+            for i in range(size):
+                mask_size += (masks >> i) & 1
+            mask_size = mask_size.astype(numpy.uint8)
+            # the value held by each mask that holds a single value
+            mask_value = numpy.zeros(1 << size, numpy.uint8)
+            mask_value[tables["value_bit"][1:]] = numpy.arange(1, size + 1)
+            tables["mask_size"] = mask_size.take
+            tables["mask_value"] = mask_value.take
+        else:
+            tables["mask_size"] = _popcount
+            tables["mask_value"] = _single_value
+    return tables
+
+
+def _popcount(masks):
+    """ Return the number of values in each of an array of 32 bit masks. """
+    masks = masks - ((masks >> 1) & 0x55555555)
+    masks = (masks & 0x33333333) + ((masks >> 2) & 0x33333333)
+    masks = (masks + (masks >> 4)) & 0x0f0f0f0f
+    return (masks * 0x01010101) >> 24
+
+
+def _single_value(masks):
+    """
+    Return the value held by each of an array of 32 bit masks that holds a
+    single value, and 0 for the other masks.
+    """
+    single = (masks != 0) & ((masks & (masks - 1)) == 0)
+    return numpy.where(single, _popcount(masks - 1) + 1, 0).astype(
+        numpy.uint8)
+
+
+def canonical_form(grid):
+    """
+    Return a (canonical, transform) tuple for a grid given as accepted by
+    solve_many().  canonical is a list of numbers that is the same for every
+    grid that can be turned into this one by relabeling the numbers,
+    transposing, permuting the rows within a band of regions or the bands
+    themselves, or permuting the columns within a stack of regions or the
+    stacks themselves.  transform is the Transform that turns the grid into
+    canonical, see apply_transform() and invert_transform().
+
+    The rows and columns are ordered by properties that these symmetries
+    preserve, such as how many numbers each one holds, and only the orders
+    that tie are compared, with the numbers relabeled in the order they
+    first appear, so the search is small for most puzzles.  Grids with many
+    ties, such as empty or completed grids, stop after _CANONICAL_LIMIT
+    arrangements and may get a form that is not shared by all of their
+    symmetric versions.
+    """
+    cells = _grid_cells(grid)
+    geometry = _geometry_for(cells)
+    size = geometry.size
+    transposed = _transposed(cells, size)
+
+    # how often each number appears, which relabeling does not change
+    frequency = [0]*(size + 1)
+    for value in cells:
+        frequency[value] += 1
+
+    row_keys = _line_keys(cells, transposed, frequency, geometry)
+    column_keys = _line_keys(transposed, cells, frequency, geometry)
+    row_profile = _band_profile(row_keys, geometry.box_size)
+    column_profile = _band_profile(column_keys, geometry.box_size)
+    orientations = []
+    if row_profile <= column_profile:
+        orientations.append((False, cells, row_keys, column_keys))
+    if column_profile <= row_profile:
+        orientations.append((True, transposed, column_keys, row_keys))
+
+    best = None
+    best_transform = None
+    arrangements = 0
+    for is_transposed, source, keys, cross_keys in orientations:
+        column_orders = list(itertools.islice(
+            _line_orders(cross_keys, geometry.box_size), _CANONICAL_LIMIT))
+        for rows in _line_orders(keys, geometry.box_size):
+            for columns in column_orders:
+                arranged = list(source[size*row + column]
+                                for row in rows for column in columns)
+                labels = _first_labels(arranged, size)
+                candidate = list(labels[value] for value in arranged)
+                if best is None or candidate < best:
+                    best = candidate
+                    best_transform = Transform(
+                        is_transposed, tuple(rows), tuple(columns),
+                        tuple(labels))
+                arrangements += 1
+                if arrangements >= _CANONICAL_LIMIT:
+                    return best, best_transform
+    return best, best_transform
+
+
+def apply_transform(grid, transform):
+    """
+    Return a grid given as accepted by solve_many() after a Transform, as a
+    list of numbers.
+    """
+    cells = _grid_cells(grid)
+    size = _geometry_for(cells).size
+    if transform.transposed:
+        cells = _transposed(cells, size)
+    labels = transform.labels
+    return list(labels[cells[size*row + column]]
+                for row in transform.rows for column in transform.columns)
+
+
+def invert_transform(grid, transform):
+    """
+    Undo a Transform, so invert_transform(apply_transform(grid, transform),
+    transform) gives back the numbers of grid.  This maps the solution of
+    a canonical puzzle back to the solution of the puzzle it came from.
+    """
+    cells = _grid_cells(grid)
+    size = _geometry_for(cells).size
+    inverse = [0]*len(transform.labels)
+    for value, label in enumerate(transform.labels):
+        inverse[label] = value
+    original = [0]*len(cells)
+    for i, row in enumerate(transform.rows):
+        for j, column in enumerate(transform.columns):
+            original[size*row + column] = inverse[cells[size*i + j]]
+    if transform.transposed:
+        original = _transposed(original, size)
+    return original
+
+
+def _transposed(cells, size):
+    """ Return a list of numbers for the transpose of a grid. """
+    return list(cells[size*column + row]
+                for row in range(size) for column in range(size))
+
+
+def _line_keys(cells, cross_cells, frequency, geometry):
+    """
+    Return a key for each row of a grid that the symmetries of
+    canonical_form() carry along with the row: the number of numbers it
+    holds, how they are spread over its regions, how many numbers the
+    columns they are in hold, and how often each of them appears in the
+    grid.  cross_cells is the transpose of cells.
+    """
+    size = geometry.size
+    box_size = geometry.box_size
+    column_counts = list(
+        size - cross_cells[size*column:size*(column + 1)].count(0)
+        for column in range(size))
+    keys = []
+    for row in range(size):
+        line = cells[size*row:size*(row + 1)]
+        filled = list(column for column in range(size) if line[column])
+        stack_counts = [0]*box_size
+        for column in filled:
+            stack_counts[column // box_size] += 1
+        keys.append((
+            len(filled),
+            tuple(sorted(stack_counts)),
+            tuple(sorted(column_counts[column] for column in filled)),
+            tuple(sorted(frequency[line[column]] for column in filled))))
+    return keys
+
+
+def _band_profile(keys, box_size):
+    """ Return the sorted keys of the bands of rows with the given keys. """
+    return tuple(sorted(
+        tuple(sorted(keys[box_size*band:box_size*(band + 1)]))
+        for band in range(box_size)))
+
+
+def _line_orders(keys, box_size):
+    """
+    Generate the orders of the rows with the given keys that keep bands
+    together, sort the bands by their keys, and sort the rows within each
+    band by their keys, as lists of row numbers.  Rows or bands with equal
+    keys are taken in every order.
+    """
+    bands = range(box_size)
+    band_rows = list(
+        sorted(range(box_size*band, box_size*(band + 1)),
+               key=lambda row: keys[row])
+        for band in bands)
+    band_keys = list(tuple(keys[row] for row in rows) for rows in band_rows)
+    band_orders = _tied_orders(sorted(bands, key=lambda band: band_keys[band]),
+                               band_keys)
+    row_orders = list(
+        list(_tied_orders(rows, keys)) for rows in band_rows)
+    for band_order in band_orders:
+        for choice in itertools.product(
+                *(row_orders[band] for band in band_order)):
+            yield list(row for rows in choice for row in rows)
+
+
+def _tied_orders(items, keys):
+    """
+    Generate the orders of a list of items sorted by key that differ only in
+    the order of items with equal keys.
+    """
+    groups = list(list(group) for _, group in itertools.groupby(
+        items, key=lambda item: keys[item]))
+    for choice in itertools.product(
+            *(itertools.permutations(group) for group in groups)):
+        yield list(item for group in choice for item in group)
+
+
+def _first_labels(cells, size):
+    """
+    Return a list that relabels the numbers in the order they first appear
+    in cells, with numbers that do not appear taking the remaining labels in
+    order, and 0 left alone.
+    """
+    labels = [0]*(size + 1)
+    label = 1
+    for value in cells:
+        if value and not labels[value]:
+            labels[value] = label
+            label += 1
+    for value in range(1, size + 1):
+        if not labels[value]:
+            labels[value] = label
+            label += 1
+    return labels
+
+
+def generate(count, seed=None, minimal=False, box_size=3, seconds=None,
+             nodes=None):
+    """
+    Generate count new puzzles as (puzzle, solution) tuples of lists of
+    numbers, with zeros for the empty locations in each puzzle.  Every
+    puzzle has exactly one solution and, unless minimal is true, can be
+    finished by solve().  With minimal=True no number can be removed from a
+    puzzle without making its solution ambiguous.  Passing the same seed
+    generates the same puzzles.  box_size sets the size of the puzzles as
+    for Sudoku().
+
+    seconds and nodes are a Budget for generating all of the puzzles.  If
+    it runs out, BudgetExceeded is raised after the puzzles finished so
+    far, with the number of them in its stats as "puzzles".
+    """
+    rng = random.Random(seed)
+    geometry = _geometry(box_size)
+    budget = _budget(seconds, nodes)
+    for generated in range(count):
+        try:
+            solution = _random_solution(rng, geometry, budget)
+            puzzle = _dig_holes(solution, rng, minimal, budget)
+        except BudgetExceeded as error:
+            error.stats["puzzles"] = generated
+            raise
+        yield puzzle, solution
+
+
+def _random_solution(rng, geometry=None, budget=None):
+    """
+    Return a random Sudoku solution as a list of numbers, 9 by 9 unless
+    another geometry is given.  The regions on the diagonal do not
+    constrain each other, so they are filled with random permutations of the
+    numbers and the rest of the grid is found by searching, within budget
+    if one is given.
+    """
+    if geometry is None:
+        geometry = _geometry(3)
+    box_size = geometry.box_size
+    start = time.time()
+    while True:
+        state = _GridState(geometry=geometry)
+        for region in range(0, geometry.size, box_size + 1):
+            values = list(range(1, geometry.size + 1))
+            rng.shuffle(values)
+            for location, value in zip(geometry.region_locations[region],
+                                       values):
+                state.place(location, value)
+        cells = next(_exact_cover(state, None, (), budget), None)
+        if cells is not None:
+            if _STATS is not None:
+                _STATS.add_phase("solution", time.time() - start)
+            return cells
+
+
+def _dig_holes(solution, rng, minimal=False, budget=None):
+    """
+    Remove numbers from a solution, given as a list of numbers, in a
+    random order and return the resulting puzzle.  Each number is put back
+    if the puzzle could no longer be finished by propagation alone.  With
+    minimal=True the remaining numbers are then tried again in a random
+    order and only put back if the solution would no longer be unique.
+    The searches for other solutions spend budget if one is given.
+    """
+    start = time.time()
+    state = _GridState(solution)
+    locations = list(range(len(solution)))
+    rng.shuffle(locations)
+    for location in locations:
+        if budget is not None:
+            budget.spend(0)
+        state.remove(location)
+        if not _deducible(state, location) and not _propagates(state):
+            state.place(location, solution[location])
+
+    if minimal:
+        # removing more numbers can only add solutions, so a number that
+        # has to stay once will always have to stay
+        locations = list(location for location in range(len(solution))
+                         if state.cells[location])
+        rng.shuffle(locations)
+        for location in locations:
+            state.remove(location)
+            if _has_other_solution(state, location, solution[location],
+                                   budget):
+                state.place(location, solution[location])
+    if _STATS is not None:
+        _STATS.add_phase("dig holes", time.time() - start)
+    return state.cells.tolist()
+
+
+def _has_other_solution(state, location, value, budget=None):
+    """
+    Determine if a grid state that has a solution with value at location
+    also has a solution with a different value there.
+    """
+    trial = state.copy()
+    trial.exclude(location, value)
+    return next(_exact_cover(trial, None, (), budget), None) is not None
+
+
+def _count_solutions(state, limit=2, engine="dlx"):
+    """
+    Count the solutions of a grid state with one of the search engines,
+    stopping once limit solutions have been found.
+    """
+    if not state.solvable():
+        return 0
+    solutions = _ENGINES[engine](state.copy())
+    return sum(1 for _ in itertools.islice(solutions, limit))
+
+
+def _deducible(state, location):
+    """
+    Determine if the value of an empty location follows directly from its
+    row, column, and region: either it has one possible value or one of its
+    possible values has no other possible location in one of its units.
+    When the rest of the grid can be finished by propagation, so can a grid
+    with such a location emptied.
+    """
+    candidates = state.candidates
+    geometry = state.geometry
+    mask = candidates[location]
+    if geometry.mask_size[mask] == 1:
+        return True
+    for unit in (geometry.region_locations[geometry.region[location]],
+                 geometry.row_locations[geometry.row[location]],
+                 geometry.column_locations[geometry.column[location]]):
+        elsewhere = 0
+        for other in unit:
+            if other != location:
+                elsewhere |= candidates[other]
+        if mask & ~elsewhere:
+            return True
+    return False
+
+
+def _propagates(state):
+    """ Determine if propagation alone fills a copy of a grid state. """
+    trial = state.copy()
+    return trial.propagate() and 0 not in trial.cells
+
+
+def _print_move(location, value, technique, size=9):
+    """
+    Print a number entered in a grid with size rows while solving and the
+    reason it was entered.
+    """
+    print("Adding", value, "at row", location // size + 1,
+          "column", location % size + 1, "-", _TECHNIQUE_REASONS[technique])
+
+
+def _backtrack(state, trace=None, strategies=(), budget=None):
+    """
+    Generate the solutions of a grid state as lists of numbers by guessing
+    and propagating the consequences of every guess.  Guesses are made for
+    the empty location with the fewest possible values, or for the missing
+    number with the fewest possible locations in a unit when that number has
+    fewer choices.  The number of guesses and dead ends are added to trace
+    if one is given, and strategies are used to propagate as in
+    _GridState.propagate().  Each guess is spent from budget if one is
+    given.  The state is modified.
+    """
+    if not state.propagate(None, strategies):
+        if trace is not None:
+            trace.dead_ends += 1
+        if _STATS is not None:
+            _STATS.dead_ends += 1
+        return
+    cells = state.cells
+    candidates = state.candidates
+    geometry = state.geometry
+    mask_size = geometry.mask_size
+
+    # find the empty location with the fewest possible values
+    best_location = None
+    best_size = geometry.size + 1
+    for location in range(geometry.locations):
+        if not cells[location]:
+            size = mask_size[candidates[location]]
+            if size < best_size:
+                best_location = location
+                best_size = size
+                if size == 2:
+                    break
+    if best_location is None:
+        # no empty locations left
+        yield cells.tolist()
+        return
+    guesses = list((best_location, value)
+                   for value in
+                   geometry.mask_values[candidates[best_location]])
+
+    if best_size > 2:
+        # look for a number with only two possible locations in a unit
+        for unit in geometry.units:
+            once = 0
+            twice = 0
+            three_times = 0
+            for location in unit:
+                mask = candidates[location]
+                three_times |= twice & mask
+                twice |= once & mask
+                once |= mask
+            only_twice = twice & ~three_times
+            if only_twice:
+                bit = only_twice & -only_twice
+                value = bit.bit_length()
+                guesses = list((location, value) for location in unit
+                               if candidates[location] & bit)
+                break
+
+    for location, value in guesses:
+        if trace is not None:
+            trace.guesses += 1
+        if budget is not None:
+            budget.spend()
+        if _STATS is not None:
+            _STATS.guesses += 1
+        guess = state.copy()
+        guess.place(location, value)
+        for solution in _backtrack(guess, trace, strategies, budget):
+            yield solution
+
+
+def _exact_cover(state, trace=None, strategies=(), budget=None):
+    """
+    Generate the solutions of a grid state as lists of numbers with Knuth's
+    Algorithm X.  Dictionaries of sets stand in for the dancing links.  The
+    rows of the exact cover problem are the (location, value) choices still
+    possible after propagation, numbered size*location + value - 1, and the
+    columns are the constraints they satisfy.  The number of choices tried
+    and dead ends are added to trace if one is given.  strategies are used
+    for the propagation before the search, and each choice tried is spent
+    from budget if one is given.  The state is modified.
+    """
+    if not state.propagate(None, strategies):
+        return
+    cells = state.cells
+    candidates = state.candidates
+    geometry = state.geometry
+    size = geometry.size
+    mask_values = geometry.mask_values
+    choice_constraints = geometry.choice_constraints
+
+    choices = {}
+    constraints = {}
+    for location in range(geometry.locations):
+        for value in mask_values[candidates[location]]:
+            choice = size*location + value - 1
+            satisfied = choice_constraints[choice]
+            choices[choice] = satisfied
+            for constraint in satisfied:
+                constraints.setdefault(constraint, set()).add(choice)
+    if len(constraints) != 4*cells.count(0):
+        # some constraint cannot be satisfied by any choice
+        if trace is not None:
+            trace.dead_ends += 1
+        return
+
+    for selected in _algorithm_x(constraints, choices, [], trace, budget):
+        solution = cells.tolist()
+        for choice in selected:
+            solution[choice // size] = choice % size + 1
+        yield solution
+
+
+def _algorithm_x(constraints, choices, selected, trace=None, budget=None):
+    """
+    Generate lists of choices that satisfy each of the constraints exactly
+    once, always branching on the constraint with the fewest choices.
+    """
+    if not constraints:
+        yield selected[:]
+        return
+    constraint = min(constraints, key=lambda c: len(constraints[c]))
+    branching = len(constraints[constraint]) > 1
+    if not constraints[constraint]:
+        if trace is not None:
+            trace.dead_ends += 1
+        if _STATS is not None:
+            _STATS.dead_ends += 1
+    for choice in list(constraints[constraint]):
+        if branching:
+            if trace is not None:
+                trace.guesses += 1
+            if _STATS is not None:
+                _STATS.guesses += 1
+        if budget is not None:
+            budget.spend()
+        selected.append(choice)
+        removed = _select_choice(constraints, choices, choice)
+        for solution in _algorithm_x(constraints, choices, selected, trace,
+                                     budget):
+            yield solution
+        _deselect_choice(constraints, choices, choice, removed)
+        selected.pop()
+
+
+def _select_choice(constraints, choices, choice):
+    """
+    Remove the constraints satisfied by choice and every choice that
+    conflicts with it, returning the removed constraints.
+    """
+    removed = []
+    for constraint in choices[choice]:
+        for other in constraints[constraint]:
+            for other_constraint in choices[other]:
+                if other_constraint != constraint:
+                    constraints[other_constraint].remove(other)
+        removed.append(constraints.pop(constraint))
+    return removed
+
+
+def _deselect_choice(constraints, choices, choice, removed):
+    """ Undo _select_choice(). """
+    for constraint in reversed(choices[choice]):
+        constraints[constraint] = removed.pop()
+        for other in constraints[constraint]:
+            for other_constraint in choices[other]:
+                if other_constraint != constraint:
+                    constraints[other_constraint].add(other)
+
+
+def _locked_candidates(state, pointing):
+    """
+    Remove possible values that are locked into the intersection of a line
+    and a region.  With pointing=True these are the numbers whose possible
+    locations in a region all lie in one row or column, which can then be
+    removed from the rest of that line.  Otherwise they are the numbers
+    whose possible locations in a row or column all lie in one region,
+    which can be removed from the rest of the region (box-line reduction).
+    Returns the number of possible values removed.
+    """
+    candidates = state.candidates
+    removed = 0
+    for segment, line_rest, region_rest in state.geometry.intersections:
+        segment_mask = 0
+        for location in segment:
+            segment_mask |= candidates[location]
+        if not segment_mask:
+            continue
+        if pointing:
+            inside, outside = region_rest, line_rest
+        else:
+            inside, outside = line_rest, region_rest
+        elsewhere = 0
+        for location in inside:
+            elsewhere |= candidates[location]
+        locked = segment_mask & ~elsewhere
+        if locked:
+            removed += _eliminate(state, outside, locked)
+    return removed
+
+
+def _naked_subsets(state, count):
+    """
+    Remove possible values using groups of count locations in a unit whose
+    possible values, taken together, are only count numbers: those numbers
+    must go in the group, so they are removed from the rest of the unit.
+    Returns the number of possible values removed.
+    """
+    candidates = state.candidates
+    mask_size = state.geometry.mask_size
+    removed = 0
+    for unit in state.geometry.units:
+        small = list(location for location in unit
+                     if 2 <= mask_size[candidates[location]] <= count)
+        if len(small) < count:
+            continue
+        for group in itertools.combinations(small, count):
+            union = 0
+            for location in group:
+                union |= candidates[location]
+            if mask_size[union] == count:
+                removed += _eliminate(
+                    state,
+                    list(location for location in unit
+                         if location not in group),
+                    union)
+    return removed
+
+
+def _hidden_subsets(state, count):
+    """
+    Remove possible values using groups of count numbers whose possible
+    locations in a unit, taken together, are only count locations: those
+    locations must hold the group, so every other possible value is
+    removed from them.  Returns the number of possible values removed.
+    """
+    candidates = state.candidates
+    geometry = state.geometry
+    mask_size = geometry.mask_size
+    removed = 0
+    for unit in geometry.units:
+        empty = list(location for location in unit if candidates[location])
+        if len(empty) <= count:
+            continue
+        # the possible locations of each number, as bit masks of positions
+        # in empty
+        places = {}
+        for position, location in enumerate(empty):
+            for value in geometry.mask_values[candidates[location]]:
+                places[value] = places.get(value, 0) | (1 << position)
+        few = sorted(value for value, mask in places.items()
+                     if 2 <= mask_size[mask] <= count)
+        for group in itertools.combinations(few, count):
+            union = 0
+            keep = 0
+            for value in group:
+                union |= places[value]
+                keep |= 1 << (value - 1)
+            if mask_size[union] == count:
+                for position, location in enumerate(empty):
+                    if union & (1 << position):
+                        removed += _eliminate(
+                            state, (location,), candidates[location] & ~keep)
+    return removed
+
+
+def _x_wing(state):
+    """
+    Remove possible values using pairs of rows in which a number has the
+    same two possible columns: the number must go in those columns in those
+    rows, so it is removed from the rest of both columns.  The same is done
+    with rows and columns swapped.  Returns the number of possible values
+    removed.
+    """
+    candidates = state.candidates
+    geometry = state.geometry
+    removed = 0
+    for lines, crossing in ((geometry.row_locations,
+                             geometry.column_locations),
+                            (geometry.column_locations,
+                             geometry.row_locations)):
+        for value in range(1, geometry.size + 1):
+            bit = 1 << (value - 1)
+            # the lines in which value has each pair of possible positions
+            pairs = {}
+            for index, line in enumerate(lines):
+                positions = tuple(position
+                                  for position, location in enumerate(line)
+                                  if candidates[location] & bit)
+                if len(positions) == 2:
+                    pairs.setdefault(positions, []).append(index)
+            for positions, found in pairs.items():
+                if len(found) != 2:
+                    continue
+                for position in positions:
+                    removed += _eliminate(
+                        state,
+                        list(location for index, location
+                             in enumerate(crossing[position])
+                             if index not in found),
+                        bit)
+    return removed
+
+
+def _eliminate(state, locations, mask):
+    """
+    Remove the values in mask from the possible values of locations and
+    return the number of possible values removed.
+    """
+    candidates = state.candidates
+    geometry = state.geometry
+    removed = 0
+    for location in locations:
+        overlap = candidates[location] & mask
+        if overlap:
+            for value in geometry.mask_values[overlap]:
+                state.exclude(location, value)
+            removed += geometry.mask_size[overlap]
+    return removed
+
+
+def _strategy_names(strategies):
+    """
+    Return the strategies named in strategies, a sequence of names from
+    STRATEGIES, "all", or None for none, as a tuple in the order of
+    STRATEGIES.  Raises ValueError for an unknown name.
+    """
+    if not strategies:
+        return ()
+    if strategies == "all":
+        return STRATEGIES
+    for name in strategies:
+        if name not in _STRATEGY_FUNCTIONS:
+            raise ValueError("unknown strategy " + repr(name))
+    return tuple(name for name in STRATEGIES if name in strategies)
+
+
+def _budget(seconds, nodes):
+    """ Return a Budget of seconds and nodes, or None for no limits. """
+    if seconds is None and nodes is None:
+        return None
+    return Budget(seconds, nodes)
+
+
+def _percentile(values, fraction):
+    """ Return the nearest rank percentile of a sorted list of values. """
+    rank = int(fraction*len(values) + 0.5)
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def _unique_choice(masks):
+    """
+    Determine if unique values can be chosen from a group of sets given as
+    bit masks, one value from each set with no value chosen twice.  This is
+    Hall's condition: every k of the sets together must hold at least k
+    values.  A value is assigned to each set in turn, moving the values
+    already assigned along an augmenting path when a set has no free value
+    left, which finds an assignment whenever one exists.
+    """
+    # the values chosen so far, and the index of the set each one was
+    # chosen for by its bit
+    assigned = 0
+    owners = {}
+    for i, mask in enumerate(masks):
+        free = mask & ~assigned
+        if free:
+            bit = free & -free
+            owners[bit] = i
+        else:
+            # a set with no members has no path either
+            bit = mask and _augment(i, masks, owners, assigned, [0])
+            if not bit:
+                return False
+        assigned |= bit
     return True
 
 
+def _augment(i, masks, owners, assigned, visited):
+    """
+    Give set i a value for _unique_choice() by taking a value from the set
+    it was chosen for, which is given another value in the same way, until
+    a set on the path has a value that is still free.  visited holds a bit
+    mask of the values already tried on the path.  Returns the bit of the
+    free value that was used, or 0 if there is no such path.
+    """
+    mask = masks[i]
+    free = mask & ~assigned
+    if free:
+        bit = free & -free
+        owners[bit] = i
+        return bit
+    choices = mask & ~visited[0]
+    while choices:
+        bit = choices & -choices
+        choices ^= bit
+        if visited[0] & bit:
+            continue
+        visited[0] |= bit
+        found = _augment(owners[bit], masks, owners, assigned, visited)
+        if found:
+            owners[bit] = i
+            return found
+    return 0
+
+
+# search functions used to finish solving after propagation stalls
+_ENGINES = {
+    "propagate": None,
+    "backtrack": _backtrack,
+    "dlx": _exact_cover,
+}
+
+# strategies that remove possible values when propagation stalls, from the
+# cheapest to the most expensive, see _GridState.propagate()
+STRATEGIES = ("pointing", "box-line reduction", "naked pair", "hidden pair",
+              "naked triple", "hidden triple", "x-wing")
+_STRATEGY_FUNCTIONS = {
+    "pointing": lambda state: _locked_candidates(state, True),
+    "box-line reduction": lambda state: _locked_candidates(state, False),
+    "naked pair": lambda state: _naked_subsets(state, 2),
+    "hidden pair": lambda state: _hidden_subsets(state, 2),
+    "naked triple": lambda state: _naked_subsets(state, 3),
+    "hidden triple": lambda state: _hidden_subsets(state, 3),
+    "x-wing": _x_wing,
+}
+
+
+def _main(arguments):
+    """ Run the command given on the command line. """
+    parser = argparse.ArgumentParser(
+        description="Solve, generate and validate Sudoku puzzles.  Puzzles "
+        "are read and written one per line as 81 characters or as blocks of "
+        "9 lines of comma separated values.  4 by 4, 16 by 16 and 25 by 25 "
+        "puzzles are read the same way, with the letters A-P for the "
+        "numbers 10-25 in the one line format.")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    solve = commands.add_parser(
+        "solve", help="solve a file of puzzles",
+        description="Solve a file of puzzles and write the solutions in the "
+        "same format, each followed by its status, on the same line in the "
+        "line format and on a line after each block in the csv format.")
+    solve.add_argument("input", help="puzzle file, - for standard input")
+    solve.add_argument("-o", "--output", default="-",
+                       help="solution file, - for standard output")
+    solve.add_argument("-f", "--format", choices=["line", "csv"],
+                       help="input and output format (default: detected)")
+    solve.add_argument("-w", "--workers", type=int, default=None,
+                       help="number of worker processes (default: CPUs)")
+    solve.add_argument("-c", "--chunksize", type=int, default=64,
+                       help="puzzles sent to a worker at a time")
+    solve.add_argument("-e", "--engine", default="dlx",
+                       choices=sorted(_ENGINES))
+    solve.add_argument("-s", "--strategies", default="",
+                       help="comma separated extra techniques from: %s, "
+                       "or all" % ", ".join(STRATEGIES))
+    solve.add_argument("-u", "--unordered", action="store_true",
+                       help="write solutions as they are finished")
+    solve.add_argument("--seconds", type=float, default=None,
+                       help="time limit of each puzzle's search")
+    solve.add_argument("--nodes", type=int, default=None,
+                       help="values a search may try for each puzzle")
+
+    generate_command = commands.add_parser(
+        "generate", help="generate puzzles",
+        description="Generate puzzles with unique solutions.")
+    generate_command.add_argument("-n", "--count", type=int, default=1,
+                                  help="number of puzzles (default: 1)")
+    generate_command.add_argument("-o", "--output", default="-",
+                                  help="puzzle file, - for standard output")
+    generate_command.add_argument("-f", "--format", default="line",
+                                  choices=["line", "csv"])
+    generate_command.add_argument("-s", "--seed", type=int, default=None)
+    generate_command.add_argument("-m", "--minimal", action="store_true",
+                                  help="remove every number that can be "
+                                  "removed, giving harder puzzles")
+    generate_command.add_argument("-b", "--box-size", type=int, default=3,
+                                  choices=sorted(_BOX_SIZES.values()),
+                                  help="3 for 9 by 9 puzzles, 2, 4 or 5 for "
+                                  "others")
+    generate_command.add_argument("--seconds", type=float, default=None,
+                                  help="time limit of the whole run")
+    generate_command.add_argument("--nodes", type=int, default=None,
+                                  help="values the searches may try")
+
+    check = commands.add_parser(
+        "validate", help="check a file of solutions",
+        description="Check that each grid in a file is a valid solution, or "
+        "with --partial that no number is repeated in a unit, and write "
+        "each grid followed by \"valid\" or the units that break the rules.")
+    check.add_argument("input", help="grid file, - for standard input")
+    check.add_argument("-o", "--output", default="-",
+                       help="report file, - for standard output")
+    check.add_argument("-f", "--format", choices=["line", "csv"],
+                       help="input format (default: detected)")
+    check.add_argument("-p", "--partial", action="store_true",
+                       help="allow empty locations")
+
+    # a file given without a command is solved, as before commands existed
+    if arguments and arguments[0] not in commands.choices and \
+            arguments[0] not in ("-h", "--help"):
+        arguments = ["solve"] + list(arguments)
+    options = parser.parse_args(arguments)
+    if options.command == "solve":
+        return _solve_command(options, solve)
+    elif options.command == "generate":
+        return _generate_command(options)
+    return _validate_command(options, check)
+
+
+def _solve_command(options, parser):
+    """ Solve a file of puzzles for _main(). """
+    strategies = options.strategies
+    if strategies != "all":
+        strategies = list(name.strip() for name in strategies.split(",")
+                          if name.strip())
+    try:
+        strategies = _strategy_names(strategies)
+    except ValueError as error:
+        parser.error(str(error))
+
+    file_format, records = _read_input(options.input, options.format,
+                                       parser)
+
+    # the number of locations of the grid read before each unreadable
+    # record, by its index, for the size of the placeholder written for it
+    placeholders = {}
+
+    def puzzles():
+        """ Report unreadable records and pass the rest on to be solved. """
+        locations = 81
+        for index, record in enumerate(records):
+            if record.error is not None:
+                sys.stderr.write("%s line %d: %s\n" % (
+                    options.input, record.line, record.error))
+                placeholders[index] = locations
+            else:
+                locations = len(record.cells)
+            yield record.cells
+
+    counts = collections.Counter()
+
+    def lines():
+        """ Format the solutions and count the results. """
+        for result in solve_many(puzzles(), options.workers,
+                                 options.chunksize, options.engine,
+                                 not options.unordered, strategies,
+                                 options.seconds, options.nodes):
+            counts[result.status] += 1
+            cells = result.solution
+            if cells is None:
+                cells = [0]*placeholders.pop(result.index)
+            if file_format == "csv":
+                yield (_cells_to_csv_string(cells) + result.status +
+                       "\n\n")
+            else:
+                yield _grid_line(cells) + " " + result.status + "\n"
+
+    start = time.time()
+    total = _write_buffered(lines(), _output(options.output))
+    elapsed = time.time() - start
+    sys.stderr.write("%d puzzles in %.2f s (%.0f puzzles/s): %s\n" % (
+        total, elapsed, total / max(elapsed, 1e-9),
+        ", ".join("%d %s" % (counts[status], status)
+                  for status in sorted(counts))))
+    return 0 if counts["solved"] == total else 1
+
+
+def _generate_command(options):
+    """ Generate puzzles for _main(). """
+    failures = []
+
+    def puzzles():
+        """ Pass on the puzzles generated until the budget runs out. """
+        try:
+            for puzzle, _ in generate(options.count, options.seed,
+                                      options.minimal, options.box_size,
+                                      options.seconds, options.nodes):
+                yield puzzle
+        except BudgetExceeded as error:
+            failures.append(error)
+
+    start = time.time()
+    total = write_puzzles(puzzles(), _output(options.output), options.format)
+    elapsed = time.time() - start
+    sys.stderr.write("%d puzzles in %.2f s (%.1f puzzles/s)\n" % (
+        total, elapsed, total / max(elapsed, 1e-9)))
+    for error in failures:
+        sys.stderr.write("%s\n" % error)
+    return 1 if failures else 0
+
+
+def _validate_command(options, parser):
+    """ Check a file of grids for _main(). """
+    _, records = _read_input(options.input, options.format, parser)
+    counts = collections.Counter()
+
+    def lines():
+        """ Check each grid and format the result. """
+        for record in records:
+            if record.error is not None:
+                counts["unreadable"] += 1
+                sys.stderr.write("%s line %d: %s\n" % (
+                    options.input, record.line, record.error))
+                continue
+            invalid = validate(record.cells, not options.partial)
+            counts["invalid" if invalid else "valid"] += 1
+            yield "%s %s\n" % (_grid_line(record.cells), ", ".join(
+                "%s %d" % (unit, index + 1)
+                for unit, index in invalid) or "valid")
+
+    total = _write_buffered(lines(), _output(options.output))
+    sys.stderr.write("%d grids: %s\n" % (total, ", ".join(
+        "%d %s" % (counts[result], result) for result in sorted(counts))))
+    return 0 if counts["valid"] == sum(counts.values()) else 1
+
+
+def _read_input(file_name, file_format, parser):
+    """
+    Return the format and the PuzzleRecords of a file given on the command
+    line, - for standard input, detecting the format if it is None.  A file
+    that cannot be opened is reported with parser.error().
+    """
+    if file_name == "-":
+        lines = sys.stdin
+        if file_format is None:
+            file_format, lines = _detect_format(lines)
+        return file_format, read_puzzles(lines, file_format)
+    try:
+        with open(file_name) as file_handle:
+            if file_format is None:
+                file_format, _ = _detect_format(file_handle)
+    except OSError as error:
+        parser.error("cannot read %s: %s" % (file_name, error.strerror))
+    # read_puzzles() closes the file it opens once the records run out
+    return file_format, read_puzzles(file_name, file_format)
+
+
+def _output(file_name):
+    """ Return standard output for -, or the file name given otherwise. """
+    return sys.stdout if file_name == "-" else file_name
 
 ################################################################################
 # Main program
 ################################################################################
 
 if __name__ == '__main__':
-
-    SUDOKU = Sudoku()
-
-    SUDOKU.new_puzzle()
-    SUDOKU.print_puzzle()
-    SUDOKU.solve()
-    SUDOKU.print_solution()
-
-    PUZZLE_FILE_NAME = "insight_sudoku_puzzle.csv"
-    SUDOKU.puzzle_from_csv(PUZZLE_FILE_NAME)
-    SUDOKU.print_puzzle()
-    SUDOKU.solve()
-    SUDOKU.print_solution()
-    SUDOKU.write_solution_to_csv("my_solution.csv")
-
+    sys.exit(_main(sys.argv[1:]))
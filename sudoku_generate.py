@@ -0,0 +1,335 @@
+"""
+A parallel generator of graded Sudoku puzzle packs.
+Generates puzzles with a pool of worker processes until there are as many
+puzzles of each difficulty as asked for, and appends them to a file as they
+are finished, one puzzle and its difficulty on each line.  Puzzles that are
+the same up to the symmetries of the grid are only written once.  The
+progress is saved next to the file, so an interrupted run picks up where it
+stopped when it is started again with the same file.
+
+Written for Python 3
+"""
+
+# import required libraries
+import argparse
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import sys
+import time
+
+import sudoku
+
+
+################################################################################
+# Lookup tables
+################################################################################
+
+# the difficulty buckets, see sudoku.SolveTrace.difficulty()
+DIFFICULTIES = ("easy", "medium", "hard", "expert")
+
+# the suffix of the file that holds the progress of a run
+_CHECKPOINT_SUFFIX = ".progress"
+
+# seconds between progress reports
+_REPORT_INTERVAL = 5.0
+
+
+################################################################################
+# Class definitions
+################################################################################
+
+class PackProgress(object):
+    """
+    The state of a run of generate_pack(): the seed and the number of tasks
+    handed out, the puzzles kept and the time spent on each difficulty, and
+    the keys of the puzzles kept so far, used to drop duplicates.
+    """
+
+    def __init__(self, seed, targets):
+        """ Start a run with no puzzles. """
+        self.seed = seed
+        self.targets = dict(targets)
+        self.tasks = 0
+        self.counts = collections.Counter()
+        self.generated = collections.Counter()
+        self.duplicates = 0
+        self.keys = set()
+        self.started = time.time()
+
+
+    def remaining(self, difficulty):
+        """ Return how many more puzzles of difficulty are wanted. """
+        return max(0, self.targets.get(difficulty, 0) -
+                   self.counts[difficulty])
+
+
+    def done(self):
+        """ Determine if every target has been met. """
+        return not any(self.remaining(difficulty)
+                       for difficulty in DIFFICULTIES)
+
+
+    def keep(self, key, difficulty):
+        """
+        Count a puzzle that was generated and return True if it should be
+        written: its bucket is not full and it is not a duplicate.
+        """
+        self.generated[difficulty] += 1
+        if not self.remaining(difficulty):
+            return False
+        if key in self.keys:
+            self.duplicates += 1
+            return False
+        self.keys.add(key)
+        self.counts[difficulty] += 1
+        return True
+
+
+    def report(self):
+        """
+        Return a line with the puzzles kept and the rate they were
+        generated at for each difficulty.
+        """
+        elapsed = max(time.time() - self.started, 1e-9)
+        return ", ".join(
+            "%s %d/%d (%.1f/s)" % (
+                difficulty, self.counts[difficulty],
+                self.targets.get(difficulty, 0),
+                self.generated[difficulty] / elapsed)
+            for difficulty in DIFFICULTIES) + ", %d duplicates" % (
+                self.duplicates)
+
+
+################################################################################
+# Function definitions
+################################################################################
+
+def generate_pack(targets, file_name, workers=None, seed=None, box_size=3,
+                  chunk_size=4, seconds=None, report=None):
+    """
+    Generate puzzles until file_name holds targets[difficulty] puzzles of
+    each difficulty, appending each puzzle in the one line format followed
+    by its difficulty as it is finished, and return the PackProgress.
+
+    Each task given to the pool generates chunk_size puzzles with its own
+    random number generator, seeded from seed and the task number, so a run
+    with a seed can be repeated.  Minimal puzzles, see sudoku.generate(),
+    are asked for by some or all of the tasks when hard or expert puzzles
+    are wanted, since those are rare otherwise.  A task that fails stops
+    the run with its exception.  Puzzles already in the file count towards
+    the targets, and the seed and the number of tasks handed out are kept
+    in file_name + ".progress", so a run that was interrupted continues
+    with new tasks.  seconds limits the time spent, and report is called
+    with a progress line every few seconds if it is given.
+    """
+    progress = _load_progress(file_name, seed, targets)
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, _ignore_interrupts)
+    try:
+        _load_keys(file_name, progress, pool)
+        with open(file_name, "a") as output:
+            _run_tasks(pool, workers, output, progress, file_name, box_size,
+                       chunk_size, seconds, report)
+    finally:
+        pool.terminate()
+        pool.join()
+        _save_progress(file_name, progress)
+    return progress
+
+
+def _run_tasks(pool, workers, output, progress, file_name, box_size,
+               chunk_size, seconds, report):
+    """
+    Keep two tasks for each of the workers in the pool until the targets are
+    met or the time is up, writing the puzzles kept as they arrive.
+    """
+    results = queue.Queue()
+    outstanding = 0
+    deadline = None if seconds is None else time.time() + seconds
+    reported = time.time()
+    while not progress.done():
+        if deadline is not None and time.time() > deadline:
+            break
+        while outstanding < 2*workers:
+            task = (progress.seed, progress.tasks, chunk_size,
+                    _wants_minimal(progress.targets, progress.tasks),
+                    box_size)
+            pool.apply_async(_generate_task, (task,),
+                             callback=results.put,
+                             error_callback=results.put)
+            progress.tasks += 1
+            outstanding += 1
+        # a timeout keeps the wait interruptible
+        try:
+            puzzles = results.get(True, 1.0)
+        except queue.Empty:
+            continue
+        outstanding -= 1
+        if isinstance(puzzles, BaseException):
+            # a failed task is never answered again, so stop the run
+            raise puzzles
+        for line, difficulty, key in puzzles:
+            if difficulty is not None and progress.keep(key, difficulty):
+                output.write("%s %s\n" % (line, difficulty))
+        output.flush()
+        _save_progress(file_name, progress)
+        if report is not None and time.time() - reported > _REPORT_INTERVAL:
+            report(progress.report())
+            reported = time.time()
+
+
+def _ignore_interrupts():
+    """
+    Leave interrupts to the main process, which stops the workers, so an
+    interrupted run does not print a traceback from every worker.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _wants_minimal(targets, number):
+    """
+    Determine if task number should generate minimal puzzles for a run with
+    targets: always if only hard or expert puzzles are wanted, every other
+    task if puzzles of every kind are, and never if no hard or expert
+    puzzles are.  The puzzles finished so far are not looked at, so the
+    tasks of a run do not depend on the order they finish in.
+    """
+    hard = targets.get("hard", 0) + targets.get("expert", 0)
+    easy = targets.get("easy", 0) + targets.get("medium", 0)
+    if not hard:
+        return False
+    return not easy or number % 2 == 1
+
+
+def _generate_task(task):
+    """
+    Generate a (seed, task number, count, minimal, box size) task in a
+    worker process and return a (line, difficulty, key) tuple for each
+    puzzle, where key identifies the puzzle up to the symmetries of the
+    grid.
+    """
+    seed, number, count, minimal, box_size = task
+    rng_seed = random.Random("%d:%d" % (seed, number)).getrandbits(64)
+    puzzles = []
+    for puzzle, _ in sudoku.generate(count, rng_seed, minimal, box_size):
+        result = next(sudoku.solve_many([puzzle], 1))
+        line = sudoku._grid_line(puzzle)
+        puzzles.append((line, result.trace.difficulty(), _puzzle_key(line)))
+    return puzzles
+
+
+def _puzzle_key(line):
+    """
+    Return a short hash of the canonical form of a puzzle in the one line
+    format, the same for every symmetric version of the puzzle.
+    """
+    canonical, _ = sudoku.canonical_form(line)
+    return hashlib.md5(sudoku._grid_line(canonical).encode()).digest()[:8]
+
+
+def _load_keys(file_name, progress, pool):
+    """
+    Count the puzzles already in file_name and add their keys to progress,
+    computing the keys with the pool.
+    """
+    if not os.path.exists(file_name):
+        return
+    lines = []
+    difficulties = []
+    with open(file_name) as file_handle:
+        for text in file_handle:
+            fields = text.split()
+            if len(fields) == 2 and fields[1] in DIFFICULTIES:
+                lines.append(fields[0])
+                difficulties.append(fields[1])
+    for key, difficulty in zip(pool.imap(_puzzle_key, lines, 256),
+                               difficulties):
+        progress.keys.add(key)
+        progress.counts[difficulty] += 1
+
+
+def _load_progress(file_name, seed, targets):
+    """
+    Return the PackProgress saved for file_name, with new targets, or a new
+    one with seed, or a random seed if seed is None.
+    """
+    checkpoint = file_name + _CHECKPOINT_SUFFIX
+    if os.path.exists(checkpoint) and os.path.exists(file_name):
+        with open(checkpoint) as file_handle:
+            saved = json.load(file_handle)
+        progress = PackProgress(saved["seed"], targets)
+        progress.tasks = saved["tasks"]
+        return progress
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(32)
+    return PackProgress(seed, targets)
+
+
+def _save_progress(file_name, progress):
+    """
+    Save the seed and the number of tasks of progress for _load_progress(),
+    replacing the old file in one step so an interruption cannot leave a
+    partial file.
+    """
+    checkpoint = file_name + _CHECKPOINT_SUFFIX
+    with open(checkpoint + ".tmp", "w") as file_handle:
+        json.dump({"seed": progress.seed, "tasks": progress.tasks},
+                  file_handle)
+    os.rename(checkpoint + ".tmp", checkpoint)
+
+
+def _main(arguments):
+    """ Generate a puzzle pack with the options given on the command line. """
+    parser = argparse.ArgumentParser(
+        description="Generate graded Sudoku puzzles in parallel and append "
+        "them to a file, one puzzle and its difficulty per line.  Run again "
+        "with the same file to resume an interrupted run.")
+    parser.add_argument("output", help="file to append the puzzles to")
+    for difficulty in DIFFICULTIES:
+        parser.add_argument("--" + difficulty, type=int, default=0,
+                            help="number of %s puzzles" % difficulty)
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of worker processes (default: CPUs)")
+    parser.add_argument("-s", "--seed", type=int, default=None,
+                        help="seed of a new run (default: random)")
+    parser.add_argument("-b", "--box-size", type=int, default=3,
+                        choices=sorted(sudoku._BOX_SIZES.values()),
+                        help="3 for 9 by 9 puzzles, 2, 4 or 5 for others")
+    parser.add_argument("-c", "--chunk-size", type=int, default=4,
+                        help="puzzles generated by a task")
+    parser.add_argument("-t", "--seconds", type=float, default=None,
+                        help="stop after this many seconds")
+    options = parser.parse_args(arguments)
+
+    targets = dict((difficulty, getattr(options, difficulty))
+                   for difficulty in DIFFICULTIES)
+    if not any(targets.values()):
+        parser.error("no puzzles asked for, use --easy, --medium, --hard or "
+                     "--expert")
+
+    def report(line):
+        """ Write a progress line. """
+        sys.stderr.write(line + "\n")
+
+    try:
+        progress = generate_pack(targets, options.output, options.workers,
+                                 options.seed, options.box_size,
+                                 options.chunk_size, options.seconds, report)
+    except KeyboardInterrupt:
+        sys.stderr.write("interrupted, run again to resume\n")
+        return 130
+    report(progress.report())
+    return 0 if progress.done() else 1
+
+################################################################################
+# Main program
+################################################################################
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
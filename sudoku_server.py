@@ -0,0 +1,612 @@
+"""
+A Sudoku solving service.
+Accepts puzzles over a TCP or Unix socket, one JSON object per line, and
+answers each with a JSON line.  Requests that arrive close together are
+collected into small batches that are solved by a pool of worker processes,
+so a slow puzzle never blocks the connections being read.  The number of
+requests waiting is bounded and each request has a deadline, and the
+service keeps latency and throughput figures that clients can ask for.
+
+A request is {"id": 1, "puzzle": "4.....8.5.3..."} with optional "engine",
+"strategies" and "timeout" (seconds) entries, and the reply is
+{"id": 1, "status": "solved", "solution": "417369825632...", ...}.  The
+status is one of the statuses of sudoku.solve_many(), "busy" if too many
+requests are waiting, or "timeout" if the deadline passed first.
+{"op": "stats"} returns the service statistics.
+
+Written for Python 3
+"""
+
+# import required libraries
+import argparse
+import collections
+import heapq
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import sudoku
+
+
+################################################################################
+# Lookup tables
+################################################################################
+
+# latencies kept for the percentiles in the statistics
+_LATENCY_WINDOW = 10000
+
+# how often, in seconds, the batcher checks deadlines while it is idle
+_IDLE_INTERVAL = 0.05
+
+
+################################################################################
+# Class definitions
+################################################################################
+
+class ServiceMetrics(object):
+    """
+    Request counts by status, batch sizes, and the latencies of the most
+    recent requests, from arrival to reply, for a SolverService.
+    """
+
+    def __init__(self):
+        """ Start with no requests. """
+        self.started = time.time()
+        self.statuses = collections.Counter()
+        self.batches = 0
+        self.batched = 0
+        self.latencies = collections.deque(maxlen=_LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+
+    def record(self, status, latency):
+        """ Count a reply with status sent latency seconds after arrival. """
+        with self._lock:
+            self.statuses[status] += 1
+            self.latencies.append(latency)
+
+
+    def record_batch(self, size):
+        """ Count a batch of size requests sent to the workers. """
+        with self._lock:
+            self.batches += 1
+            self.batched += size
+
+
+    def snapshot(self):
+        """
+        Return a dictionary of the replies by status, the throughput since
+        the service started, the mean batch size, and the p50, p90 and p99
+        latencies of recent requests in milliseconds.
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            statuses = dict(self.statuses)
+            batches = self.batches
+            batched = self.batched
+        uptime = time.time() - self.started
+        replies = sum(statuses.values())
+        stats = {
+            "uptime_seconds": uptime,
+            "replies": replies,
+            "statuses": statuses,
+            "requests_per_second": replies / uptime if uptime > 0 else None,
+            "batches": batches,
+            "mean_batch_size": float(batched) / batches if batches else None,
+        }
+        if latencies:
+            for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+                stats[name + "_ms"] = 1000*sudoku._percentile(
+                    latencies, fraction)
+            stats["max_ms"] = 1000*latencies[-1]
+        return stats
+
+
+class _Request(object):
+    """ A puzzle waiting to be solved and the way to answer it. """
+
+    __slots__ = ("request_id", "puzzle", "engine", "strategies", "canonical",
+                 "arrived", "deadline", "reply", "done")
+
+    def __init__(self, request_id, puzzle, engine, strategies, canonical,
+                 deadline, reply):
+        """
+        Make a request that has just arrived.  canonical is the (key,
+        transform) the cache looked the puzzle up with, or None.
+        """
+        self.request_id = request_id
+        self.puzzle = puzzle
+        self.engine = engine
+        self.strategies = strategies
+        self.canonical = canonical
+        self.arrived = time.time()
+        self.deadline = deadline
+        self.reply = reply
+        self.done = False
+
+
+class SolverService(object):
+    """
+    Collects solve requests into batches and solves them with a pool of
+    worker processes.
+
+    Requests are batched for up to batch_window seconds or until max_batch
+    of them have arrived, and at most two batches per worker are given to
+    the pool at a time.  Further requests wait in a queue, and once
+    max_pending requests are waiting or being solved new ones are answered
+    "busy" at once rather than queued, so a client that sends too much is
+    slowed down instead of the service running out of memory.  A request
+    that is not solved within its timeout is answered "timeout", and the
+    worker solving it gives up once the time is spent, see sudoku.Budget.
+    The timeout a request asks for is cut to max_timeout seconds, so one
+    client cannot hold a worker for longer than that.  With cache_size set,
+    solved puzzles are kept in a SolutionCache and requests for them, or
+    for puzzles that are the same up to the symmetries of the grid, are
+    answered without a worker.
+    """
+
+    def __init__(self, workers=None, batch_window=0.005, max_batch=64,
+                 max_pending=10000, timeout=10.0, engine="dlx",
+                 cache_size=0, max_timeout=60.0):
+        """
+        Start the worker pool and the batcher.  workers defaults to the
+        number of CPUs.
+        """
+        if engine not in sudoku._ENGINES:
+            raise ValueError("unknown engine " + repr(engine))
+        workers = workers or multiprocessing.cpu_count()
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.max_timeout = max_timeout
+        self.engine = engine
+        self.metrics = ServiceMetrics()
+        self.cache = sudoku.SolutionCache(cache_size) if cache_size else None
+
+        self._pool = multiprocessing.Pool(workers)
+        self._slots = threading.Semaphore(2*workers)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._in_flight = 0
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._running = True
+        self._batcher = threading.Thread(target=self._batch_requests)
+        self._batcher.daemon = True
+        self._batcher.start()
+
+
+    def submit(self, line, reply):
+        """
+        Handle one request line, calling reply with a dictionary to send
+        back once the answer is known, possibly from another thread.
+        """
+        try:
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise ValueError("a request must be a JSON object")
+        except ValueError as error:
+            self._reply_now(reply, None, "error", str(error))
+            return
+        request_id = message.get("id")
+        operation = message.get("op", "solve")
+        if operation == "stats":
+            reply({"id": request_id, "status": "ok", "stats": self.stats()})
+            return
+        if operation != "solve":
+            self._reply_now(reply, request_id, "error",
+                            "unknown op " + repr(operation))
+            return
+
+        engine = message.get("engine", self.engine)
+        try:
+            if engine not in sudoku._ENGINES:
+                raise ValueError("unknown engine " + repr(engine))
+            strategies = sudoku._strategy_names(message.get("strategies"))
+            timeout = float(message.get("timeout", self.timeout))
+            if not (math.isfinite(timeout) and timeout > 0):
+                raise ValueError("timeout must be a positive number of "
+                                 "seconds")
+            timeout = min(timeout, self.max_timeout)
+            puzzle = sudoku._grid_cells(message["puzzle"])
+        except Exception as error:
+            self._reply_now(reply, request_id, "error", str(error))
+            return
+
+        # canonicalizing a grid with many symmetries takes a while, so it
+        # is done before taking the lock and the result kept for the store
+        canonical = None
+        if self.cache is not None and not strategies:
+            try:
+                cells, transform = sudoku.canonical_form(puzzle)
+            except ValueError:
+                pass
+            else:
+                canonical = (sudoku._grid_line(cells), transform)
+                with self._lock:
+                    solution = self.cache._lookup(*canonical)
+                if solution is not None:
+                    self._reply_now(reply, request_id, "solved", None,
+                                    solution=sudoku._grid_line(solution),
+                                    cached=True)
+                    return
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                busy = True
+            else:
+                busy = False
+                self._pending += 1
+        if busy:
+            self._reply_now(reply, request_id, "busy",
+                            "too many requests waiting")
+            return
+        request = _Request(request_id, puzzle, engine, strategies,
+                           canonical, time.time() + timeout, reply)
+        with self._lock:
+            heapq.heappush(self._deadlines,
+                           (request.deadline, next(self._sequence), request))
+        self._queue.put(request)
+
+
+    def stats(self):
+        """
+        Return the statistics of ServiceMetrics.snapshot() along with the
+        number of requests waiting and being solved and the cache counts.
+        """
+        stats = self.metrics.snapshot()
+        with self._lock:
+            stats["pending"] = self._pending
+            stats["queued"] = self._queue.qsize()
+            stats["in_flight"] = self._in_flight
+            if self.cache is not None:
+                stats["cache"] = self.cache.stats()
+        return stats
+
+
+    def close(self):
+        """ Stop the batcher and the worker pool. """
+        self._running = False
+        self._batcher.join()
+        self._pool.terminate()
+        self._pool.join()
+
+
+    def _reply_now(self, reply, request_id, status, error, **fields):
+        """ Answer a request that was never queued. """
+        message = {"id": request_id, "status": status}
+        if error is not None:
+            message["error"] = error
+        message.update(fields)
+        self.metrics.record(status, 0.0)
+        reply(message)
+
+
+    def _finish(self, request, status, **fields):
+        """
+        Answer a queued request unless it was answered already, as happens
+        when it timed out while a worker was solving it.
+        """
+        with self._lock:
+            if request.done:
+                return
+            request.done = True
+            self._pending -= 1
+        message = {"id": request.request_id, "status": status}
+        message.update(fields)
+        self.metrics.record(status, time.time() - request.arrived)
+        request.reply(message)
+
+
+    def _expire(self):
+        """ Answer "timeout" to every request whose deadline has passed. """
+        now = time.time()
+        expired = []
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                expired.append(heapq.heappop(self._deadlines)[2])
+        for request in expired:
+            self._finish(request, "timeout")
+
+
+    def _batch_requests(self):
+        """
+        Collect queued requests into batches and give them to the pool,
+        waiting for a free slot so the pool never holds more than two
+        batches a worker.
+        """
+        while self._running:
+            self._expire()
+            try:
+                first = self._queue.get(True, _IDLE_INTERVAL)
+            except queue.Empty:
+                continue
+            batch = [first]
+            closing = time.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = closing - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(True, remaining))
+                except queue.Empty:
+                    break
+            while not self._slots.acquire(False):
+                # keep answering timeouts while the workers are busy
+                self._expire()
+                if not self._running:
+                    return
+                time.sleep(0.001)
+            self._expire()
+            batch = list(request for request in batch if not request.done)
+            if not batch:
+                self._slots.release()
+                continue
+            jobs = list((request.puzzle, request.engine, request.strategies,
+                         request.deadline)
+                        for request in batch)
+            with self._lock:
+                self._in_flight += len(batch)
+            self.metrics.record_batch(len(batch))
+            self._pool.apply_async(
+                _solve_batch, (jobs,),
+                callback=lambda results, batch=batch:
+                self._batch_done(batch, results))
+
+
+    def _batch_done(self, batch, results):
+        """ Answer the requests of a batch the pool has solved. """
+        self._slots.release()
+        with self._lock:
+            self._in_flight -= len(batch)
+        for request, (status, solution, difficulty) in zip(batch, results):
+            if (request.canonical is not None and status == "solved" and
+                    not request.done):
+                key, transform = request.canonical
+                canonical = sudoku._grid_line(sudoku.apply_transform(
+                    sudoku._grid_cells(solution), transform))
+                with self._lock:
+                    self.cache._store(key, canonical)
+            fields = {}
+            if solution is not None:
+                fields["solution"] = solution
+            if difficulty is not None:
+                fields["difficulty"] = difficulty
+            self._finish(request, status, **fields)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """ A TCP server that reads each connection in its own thread. """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class _UnixServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+        """ A Unix socket server that reads each connection in a thread. """
+
+        daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """
+    Reads request lines from a connection and writes the replies as they
+    are ready, which may not be in the order the requests were sent.
+    Replies are put on a queue that a writer thread of the connection
+    sends, so the pool and the batcher never wait on a client that is slow
+    to read its replies.
+    """
+
+    def handle(self):
+        """ Serve one connection until the client stops sending. """
+        service = self.server.service
+        replies = queue.Queue()
+        writer = threading.Thread(target=self._write_replies,
+                                  args=(replies,))
+        writer.daemon = True
+        writer.start()
+        lock = threading.Condition()
+        outstanding = [0]
+
+        def reply(message):
+            """ Queue a reply line for the writer. """
+            replies.put(json.dumps(message, sort_keys=True) + "\n")
+            with lock:
+                outstanding[0] -= 1
+                lock.notify_all()
+
+        for line in iter(self.rfile.readline, b""):
+            if not line.strip():
+                continue
+            with lock:
+                outstanding[0] += 1
+            service.submit(line, reply)
+
+        # every request is answered by its deadline, so this ends
+        with lock:
+            while outstanding[0]:
+                lock.wait()
+        replies.put(None)
+        writer.join()
+
+
+    def _write_replies(self, replies):
+        """
+        Send the reply lines on a queue until None is found, dropping them
+        once the client has gone.
+        """
+        connected = True
+        for line in iter(replies.get, None):
+            if not connected:
+                continue
+            try:
+                self.wfile.write(line.encode())
+                self.wfile.flush()
+            except socket.error:
+                connected = False
+
+
+class SolverClient(object):
+    """
+    A blocking client for the service, for scripts and tests.  Requests are
+    sent one at a time and each reply is returned as a dictionary.
+    """
+
+    def __init__(self, address):
+        """
+        Connect to a service at a (host, port) address or a Unix socket
+        path.
+        """
+        if isinstance(address, str):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.connect(address)
+        self._file = self._socket.makefile("rw")
+        self._ids = itertools.count()
+
+
+    def request(self, message):
+        """ Send a request dictionary and return the reply. """
+        message = dict(message)
+        message.setdefault("id", next(self._ids))
+        self._file.write(json.dumps(message) + "\n")
+        self._file.flush()
+        return json.loads(self._file.readline())
+
+
+    def solve(self, puzzle, **options):
+        """
+        Solve a puzzle given as accepted by sudoku.solve_many(), with the
+        optional engine, strategies and timeout entries of a request.
+        """
+        if not isinstance(puzzle, str):
+            puzzle = sudoku._grid_line(sudoku._grid_cells(puzzle))
+        options["puzzle"] = puzzle
+        return self.request(options)
+
+
+    def stats(self):
+        """ Return the service statistics. """
+        return self.request({"op": "stats"})["stats"]
+
+
+    def close(self):
+        """ Close the connection. """
+        self._file.close()
+        self._socket.close()
+
+
+################################################################################
+# Function definitions
+################################################################################
+
+def make_server(address, service):
+    """
+    Return a server that answers requests at a (host, port) address or a
+    Unix socket path with service.  Call its serve_forever() method to run
+    it.
+    """
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.remove(address)
+        server = _UnixServer(address, _Handler)
+    else:
+        server = _Server(address, _Handler)
+    server.service = service
+    return server
+
+
+def _solve_batch(jobs):
+    """
+    Solve a batch of (puzzle, engine, strategies, deadline) jobs in a
+    worker process and return a (status, solution line, difficulty) tuple
+    for each.  Each puzzle gets the time left before its deadline when it
+    starts, and one whose deadline has passed is reported as a "timeout"
+    without being solved, as the client has been told already.  A puzzle
+    that makes the solver fail is reported as an "error" so the rest of the
+    batch is still answered.
+    """
+    results = []
+    for puzzle, engine, strategies, deadline in jobs:
+        seconds = deadline - time.time()
+        if seconds <= 0:
+            results.append(("timeout", None, None))
+            continue
+        try:
+            result = next(sudoku.solve_many([puzzle], 1, engine=engine,
+                                            strategies=strategies,
+                                            seconds=seconds))
+        except Exception:
+            results.append(("error", None, None))
+            continue
+        if result.solution is None:
+            results.append((result.status, None, None))
+        else:
+            results.append((result.status,
+                            sudoku._grid_line(result.solution),
+                            result.trace.difficulty()))
+    return results
+
+
+def _main(arguments):
+    """ Run the service with the options given on the command line. """
+    parser = argparse.ArgumentParser(
+        description="Serve Sudoku solutions over a socket, one JSON request "
+        "per line.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8765)
+    parser.add_argument("--unix", help="listen on this Unix socket instead")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of worker processes (default: CPUs)")
+    parser.add_argument("--batch-window", type=float, default=0.005,
+                        help="seconds to collect a batch (default: 0.005)")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-pending", type=int, default=10000,
+                        help="requests waiting before answering busy")
+    parser.add_argument("-t", "--timeout", type=float, default=10.0,
+                        help="default seconds before answering timeout")
+    parser.add_argument("--max-timeout", type=float, default=60.0,
+                        help="most seconds a request may ask for "
+                        "(default: 60)")
+    parser.add_argument("-e", "--engine", default="dlx",
+                        choices=sorted(sudoku._ENGINES))
+    parser.add_argument("--cache", type=int, default=0,
+                        help="solutions to cache (default: no cache)")
+    options = parser.parse_args(arguments)
+
+    service = SolverService(options.workers, options.batch_window,
+                            options.max_batch, options.max_pending,
+                            options.timeout, options.engine, options.cache,
+                            options.max_timeout)
+    address = options.unix or (options.host, options.port)
+    server = make_server(address, service)
+    sys.stderr.write("serving on %s\n" % (address,))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        sys.stderr.write(json.dumps(service.stats(), sort_keys=True) + "\n")
+    return 0
+
+################################################################################
+# Main program
+################################################################################
+
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))
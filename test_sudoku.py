@@ -0,0 +1,207 @@
+"""
+Tests for the Sudoku module.
+Checks the incremental updates of the possible values against a full
+rebuild of the grid, hints against solving, the difficulty grades of the
+search engines against each other, and the per-unit solvability check
+against trying every assignment.
+
+Written for Python 3
+"""
+
+# import required libraries
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import sudoku
+
+
+################################################################################
+# Lookup tables
+################################################################################
+
+# the sample puzzle that ships with the module
+_BUNDLED_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "insight_sudoku_puzzle.csv")
+
+# a well known hard puzzle that singles alone do not finish
+_HARD_PUZZLE = ("4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7"
+                ".5..2.....1.4......")
+
+
+################################################################################
+# Class definitions
+################################################################################
+
+class MoveTest(unittest.TestCase):
+    """ Tests of the place(), erase() and undo() moves of Sudoku. """
+
+    def assert_rebuilt(self, game):
+        """
+        Check that the possible values of game are the ones a full rebuild
+        of its solution gives.
+        """
+        state = game._state
+        rebuilt = sudoku._GridState(game._solution.flatten().tolist(),
+                                    game._geometry)
+        self.assertEqual(list(state.cells), list(rebuilt.cells))
+        self.assertEqual(list(state.row_masks), list(rebuilt.row_masks))
+        self.assertEqual(list(state.column_masks),
+                         list(rebuilt.column_masks))
+        self.assertEqual(list(state.region_masks),
+                         list(rebuilt.region_masks))
+        self.assertEqual(state.candidates, rebuilt.candidates)
+
+
+    def test_random_moves_match_rebuild(self):
+        """ A random run of moves matches a rebuild after every step. """
+        game = sudoku.Sudoku()
+        game.puzzle_from_csv(_BUNDLED_FILE)
+        size = game._geometry.size
+        empty = list((row, column) for row in range(size)
+                     for column in range(size)
+                     if not game._puzzle[row, column])
+        rng = random.Random(0)
+        for _ in range(3000):
+            choice = rng.random()
+            row, column = rng.choice(empty)
+            if choice < 0.5:
+                game.place(row, column, rng.randint(1, size))
+            elif choice < 0.75:
+                game.erase(row, column)
+            else:
+                game.undo()
+            self.assert_rebuilt(game)
+
+
+    def test_undo_restores_puzzle(self):
+        """ Undoing every move leaves the grid as the puzzle gave it. """
+        game = sudoku.Sudoku()
+        game.puzzle_from_csv(_BUNDLED_FILE)
+        puzzle = game._puzzle.copy()
+        candidates = list(game._state.candidates)
+        rng = random.Random(1)
+        size = game._geometry.size
+        for _ in range(200):
+            row, column = rng.randrange(size), rng.randrange(size)
+            if not puzzle[row, column]:
+                game.place(row, column, rng.randint(1, size))
+        while game.undo():
+            pass
+        self.assertTrue((game._solution == puzzle).all())
+        self.assertEqual(game._state.candidates, candidates)
+
+
+    def test_candidates_outside_grid(self):
+        """ candidates() refuses rows and columns outside the grid. """
+        game = sudoku.Sudoku()
+        game.puzzle_from_csv(_BUNDLED_FILE)
+        for row, column in ((0, 9), (9, 0), (-1, 0), (0, -1)):
+            self.assertRaises(ValueError, game.candidates, row, column)
+
+
+class HintTest(unittest.TestCase):
+    """ Tests of the next_step() hints of Sudoku. """
+
+    def setUp(self):
+        """ Make a directory for puzzle files. """
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        """ Remove the puzzle files. """
+        shutil.rmtree(self.directory)
+
+
+    def follow_hints(self, game, strategies):
+        """
+        Enter the numbers game.next_step() finds with strategies until it
+        finds no more, checking that place() accepts each of them.
+        """
+        step = game.next_step(strategies)
+        while step is not None:
+            self.assertTrue(game.place(step.row, step.column, step.digit))
+            step = game.next_step(strategies)
+
+
+    def test_hints_finish_hard_puzzle(self):
+        """
+        Following the hints with every strategy finishes a hard puzzle with
+        the solution solve_many() finds.
+        """
+        file_name = os.path.join(self.directory, "hard.csv")
+        with open(file_name, "w") as file_handle:
+            file_handle.write(sudoku._cells_to_csv_string(
+                sudoku._grid_cells(_HARD_PUZZLE)))
+        game = sudoku.Sudoku()
+        game.puzzle_from_csv(file_name)
+        # singles alone stop long before the end
+        self.follow_hints(game, ())
+        self.assertIn(0, game._solution)
+        self.follow_hints(game, "all")
+        solution = next(sudoku.solve_many([_HARD_PUZZLE], 1)).solution
+        self.assertEqual(game._solution.flatten().tolist(), solution)
+
+
+class GradeTest(unittest.TestCase):
+    """ Tests of the difficulty grades of SolveTrace. """
+
+    def test_engines_agree(self):
+        """ Minimal puzzles get the same grade from every search engine. """
+        for puzzle, _ in sudoku.generate(40, 7, True):
+            grades = set()
+            for engine in ("backtrack", "dlx"):
+                trace = sudoku.SolveTrace()
+                sudoku._solve_state(sudoku._GridState(puzzle), engine, trace)
+                grades.add((trace.score(), trace.difficulty()))
+            self.assertEqual(len(grades), 1, puzzle)
+
+
+class UniqueChoiceTest(unittest.TestCase):
+    """ Tests of the per-unit check _unique_choice(). """
+
+    def test_matches_exhaustive_assignment(self):
+        """
+        _unique_choice() agrees with trying every assignment on random
+        units of 9 sets.
+        """
+        rng = random.Random(0)
+        answers = set()
+        for _ in range(20000):
+            masks = list(
+                sum(1 << value for value in range(9) if rng.random() < 0.25)
+                for _ in range(rng.randint(1, 9)))
+            expected = _exhaustive_choice(masks)
+            answers.add(expected)
+            self.assertEqual(sudoku._unique_choice(masks), expected, masks)
+        # both answers were checked
+        self.assertEqual(answers, set((True, False)))
+
+
+################################################################################
+# Function definitions
+################################################################################
+
+def _exhaustive_choice(masks, used=0):
+    """
+    Determine if a value can be chosen from each of masks with no value
+    chosen twice by trying every choice.
+    """
+    if not masks:
+        return True
+    choices = masks[0] & ~used
+    while choices:
+        bit = choices & -choices
+        choices ^= bit
+        if _exhaustive_choice(masks[1:], used | bit):
+            return True
+    return False
+
+################################################################################
+# Main program
+################################################################################
+
+if __name__ == '__main__':
+    unittest.main()